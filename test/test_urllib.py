@@ -754,6 +754,241 @@ class urlretrieve_FileTests(unittest.TestCase):
         self.assertEqual(report[2][1], 8192)
 
 
+    @async_test
+    def test_conditional(self):
+        # validators are kept beside the file and sent back next time;
+        # a 304 leaves the file alone
+        target = "%s.2" % support.TESTFN
+        self.registerFileForCleanUp(target)
+        self.registerFileForCleanUp(target + ".urlmeta")
+        url = "http://example.com/file"
+        requests = []
+
+        @asyncio.coroutine
+        def fake_urlopen(req, data=None):
+            requests.append(req)
+            headers = email.message_from_string('ETag: "1"\n')
+            if isinstance(req, request.Request) and \
+                    req.get_header("If-none-match") == '"1"':
+                raise error.HTTPError(url, 304, "Not Modified", headers, None)
+            return request.addinfourl(io.BytesIO(self.text), headers, url)
+
+        with patch.object(request, "urlopen", fake_urlopen):
+            for i in range(2):
+                result = yield from request.urlretrieve(url, target,
+                                                        conditional=True)
+                self.assertEqual(result[0], target)
+                with open(target, "rb") as f:
+                    self.assertEqual(f.read(), self.text)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(result[1]["ETag"], '"1"')
+
+    @async_test
+    def test_conditional_interrupted(self):
+        # a 200 cut off halfway must not leave the old validators behind
+        # for a later 304 to vouch for the truncated file
+        target = "%s.2" % support.TESTFN
+        self.registerFileForCleanUp(target)
+        self.registerFileForCleanUp(target + ".urlmeta")
+        url = "http://example.com/file"
+        requests = []
+
+        class CutOff(io.BytesIO):
+            def read(self, n=-1):
+                if self.tell() >= 4:
+                    raise ConnectionResetError
+                return super().read(4)
+            def readinto(self, b):
+                if self.tell() >= 4:
+                    raise ConnectionResetError
+                return super().readinto(memoryview(b)[:4])
+
+        @asyncio.coroutine
+        def fake_urlopen(req, data=None):
+            requests.append(req)
+            headers = email.message_from_string('ETag: "1"\n')
+            if len(requests) == 2:
+                return request.addinfourl(CutOff(self.text), headers, url)
+            if isinstance(req, request.Request) and \
+                    req.get_header("If-none-match") == '"1"':
+                raise error.HTTPError(url, 304, "Not Modified", headers, None)
+            return request.addinfourl(io.BytesIO(self.text), headers, url)
+
+        with patch.object(request, "urlopen", fake_urlopen):
+            yield from request.urlretrieve(url, target, conditional=True)
+            with self.assertRaises(ConnectionResetError):
+                yield from request.urlretrieve(url, target, conditional=True)
+            yield from request.urlretrieve(url, target, conditional=True)
+        self.assertEqual(len(requests), 3)
+        self.assertNotIsInstance(requests[2], request.Request)
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), self.text)
+
+    @async_test
+    def test_resume(self):
+        # a cut-off download is picked up with Range and If-Range
+        target = "%s.2" % support.TESTFN
+        self.registerFileForCleanUp(target)
+        self.registerFileForCleanUp(target + ".urlmeta")
+        url = "http://example.com/file"
+        body = b"0123456789"
+        requests = []
+
+        @asyncio.coroutine
+        def fake_urlopen(req, data=None):
+            requests.append(req)
+            rng = req.get_header("Range")
+            if rng is None:
+                headers = email.message_from_string(
+                    'ETag: "1"\nContent-Length: 10\n')
+                # the connection drops after four bytes
+                return request.addinfourl(io.BytesIO(body[:4]), headers,
+                                          url, 200)
+            self.assertEqual(req.get_header("If-range"), '"1"')
+            start = int(rng[6:-1])
+            headers = email.message_from_string(
+                'ETag: "1"\nContent-Range: bytes %d-9/10\n'
+                'Content-Length: %d\n' % (start, 10 - start))
+            return request.addinfourl(io.BytesIO(body[start:]), headers,
+                                      url, 206)
+
+        with patch.object(request, "urlopen", fake_urlopen):
+            result = yield from request.urlretrieve(url, target, resume=True)
+        self.assertEqual(result[0], target)
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), body)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[1].get_header("Range"), "bytes=4-")
+
+    @async_test
+    def test_resume_range_ignored(self):
+        # a server that ignores Range and keeps cutting off at the same
+        # point makes no progress, so the attempts run out
+        target = "%s.2" % support.TESTFN
+        self.registerFileForCleanUp(target)
+        self.registerFileForCleanUp(target + ".urlmeta")
+        url = "http://example.com/file"
+        requests = []
+
+        @asyncio.coroutine
+        def fake_urlopen(req, data=None):
+            requests.append(req)
+            if len(requests) > 10:
+                self.fail("retried forever")
+            headers = email.message_from_string(
+                'ETag: "1"\nContent-Length: 10\n')
+            return request.addinfourl(io.BytesIO(b"0123"), headers, url, 200)
+
+        with patch.object(request, "urlopen", fake_urlopen):
+            with self.assertRaises(error.ContentTooShortError):
+                yield from request.urlretrieve(url, target, resume=True,
+                                               resume_attempts=2)
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(requests[2].get_header("Range"), "bytes=4-")
+
+    @async_test
+    def test_resume_interrupted(self):
+        # a connection that drops partway still counts as progress for
+        # the bytes that made it to disk
+        target = "%s.2" % support.TESTFN
+        self.registerFileForCleanUp(target)
+        self.registerFileForCleanUp(target + ".urlmeta")
+        url = "http://example.com/file"
+        body = b"0123456789"
+        requests = []
+
+        class CutOff(io.BytesIO):
+            # hands out three bytes, then the connection resets
+            def read(self, n=-1):
+                if self.tell() >= 3:
+                    raise ConnectionResetError
+                return super().read(3)
+            def readinto(self, b):
+                if self.tell() >= 3:
+                    raise ConnectionResetError
+                return super().readinto(memoryview(b)[:3])
+
+        @asyncio.coroutine
+        def fake_urlopen(req, data=None):
+            requests.append(req)
+            start = int((req.get_header("Range") or "bytes=0-")[6:-1])
+            headers = email.message_from_string(
+                'ETag: "1"\nContent-Range: bytes %d-9/10\n'
+                'Content-Length: %d\n' % (start, 10 - start))
+            return request.addinfourl(CutOff(body[start:]), headers,
+                                      url, 206 if start else 200)
+
+        with patch.object(request, "urlopen", fake_urlopen):
+            yield from request.urlretrieve(url, target, resume=True,
+                                           resume_attempts=1)
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), body)
+        self.assertEqual([r.get_header("Range") for r in requests],
+                         [None, "bytes=3-", "bytes=6-", "bytes=9-"])
+
+    @async_test
+    def test_segments(self):
+        # byte ranges are fetched separately and land at their offsets
+        target = "%s.2" % support.TESTFN
+        self.registerFileForCleanUp(target)
+        url = "http://example.com/file"
+        body = bytes(range(100))
+        ranges = []
+
+        @asyncio.coroutine
+        def fake_urlopen(req, data=None):
+            first, last = map(int, req.get_header("Range")[6:].split("-"))
+            ranges.append((first, last))
+            headers = email.message_from_string(
+                'ETag: "1"\nContent-Range: bytes %d-%d/100\n' % (first, last))
+            return request.addinfourl(io.BytesIO(body[first:last + 1]),
+                                      headers, url, 206)
+
+        reports = []
+        with patch.object(request, "urlopen", fake_urlopen):
+            result = yield from request.urlretrieve(
+                url, target, lambda *args: reports.append(args),
+                segments=4, min_segment_size=10)
+        self.assertEqual(result[0], target)
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), body)
+        self.assertEqual(sorted(ranges), [(0, 0), (0, 24), (25, 49),
+                                          (50, 74), (75, 99)])
+        # the headers describe the whole file, not the probe's one byte
+        headers = result[1]
+        self.assertEqual(headers["Content-Length"], "100")
+        self.assertIsNone(headers["Content-Range"])
+        self.assertEqual(headers["ETag"], '"1"')
+        # progress adds up across the segments
+        self.assertEqual(reports[0], (0, 64 * 1024, 100))
+        self.assertEqual(reports[-1], (1, 64 * 1024, 100))
+        self.assertEqual(len(reports), 5)
+
+    @async_test
+    def test_copy_response(self):
+        # blocks grow while the body fills them and land in order; a
+        # failed write is raised once the reader stops
+        body = bytes(range(256)) * 1000
+        headers = email.message_from_string("Content-Length: %d\n"
+                                            % len(body))
+        fp = request.addinfourl(io.BytesIO(body), headers, "http://x/")
+        tfp = io.BytesIO()
+        sizes = []
+        write = tfp.write
+        tfp.write = lambda data: sizes.append(len(data)) or write(data)
+        result = yield from request._copy_response(fp, tfp, max_bs=65536)
+        self.assertEqual(result, (len(body), len(body)))
+        self.assertEqual(tfp.getvalue(), body)
+        self.assertEqual(sizes[:4], [8192, 16384, 32768, 65536])
+
+        class BrokenFile:
+            def write(self, data):
+                raise OSError("disk full")
+        fp = request.addinfourl(io.BytesIO(body), headers, "http://x/")
+        with self.assertRaises(OSError):
+            yield from request._copy_response(fp, BrokenFile())
+
+
 class urlretrieve_HttpTests(unittest.TestCase): #, FakeHTTPMixin):
     """Test urllib.urlretrieve() using fake http connections"""
 
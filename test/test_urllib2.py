@@ -7,6 +7,8 @@ import array
 import sys
 import asyncio
 import functools
+import tempfile
+import time
 
 sys.path.insert(0, '../yieldfrom/urllib')
 #import urllib.request
@@ -410,6 +412,26 @@ class MockHTTPClass:
         if self.raise_on_endheaders:
             raise OSError()
 
+    # the lower-level calls, used for streamed bodies
+    def putrequest(self, method, url, skip_host=False,
+                   skip_accept_encoding=False):
+        self.method = method
+        self.selector = url
+        self.sent = []
+
+    def putheader(self, header, *values):
+        self.req_headers.append((header, ', '.join(map(str, values))))
+
+    @asyncio.coroutine
+    def endheaders(self, message_body=None):
+        yield None
+        self.req_headers.sort()
+
+    @asyncio.coroutine
+    def send(self, data):
+        yield None
+        self.sent.append(data)
+
     @asyncio.coroutine
     def getresponse(self):
         yield None
@@ -637,6 +659,54 @@ class OpenerDirectorTests(unittest.TestCase):
         self.assertEqual(o.calls[0][0], handlers[1])
         self.assertEqual(o.calls[1][0], handlers[0])
 
+    @async_test
+    def test_compiled_chain(self):
+        # plain and coroutine handler methods are both dispatched from the
+        # table built by add_handler
+        class PlainHandler(request.BaseHandler):
+            handler_order = 100
+            def http_open(self, req):
+                return None
+        class CoroutineHandler(request.BaseHandler):
+            @asyncio.coroutine
+            def http_open(self, req):
+                yield None
+                return self
+        o = OpenerDirector()
+        coroutine_handler = CoroutineHandler()
+        o.add_handler(coroutine_handler)
+        o.add_handler(PlainHandler())
+        self.assertEqual([c for f, c in o._open_methods['http']],
+                         [False, True])
+        r = yield from o.open("http://example.com/")
+        self.assertIs(r, coroutine_handler)
+
+    @async_test
+    def test_awaitable_results(self):
+        # plain handler methods may return futures or other awaitables
+        class Awaitable:
+            def __init__(self, value):
+                self.value = value
+            def __await__(self):
+                yield from asyncio.sleep(0)
+                return self.value
+        class AwaitableHandler(request.BaseHandler):
+            def http_request(self, req):
+                req.add_header('X-Seen', 'yes')
+                return Awaitable(req)
+            def http_open(self, req):
+                future = asyncio.Future(loop=testLoop)
+                future.set_result(MockResponse(200, "OK", {}, ""))
+                return future
+            def http_response(self, req, response):
+                return Awaitable(response)
+        o = OpenerDirector()
+        o.add_handler(AwaitableHandler())
+        req = Request("http://example.com/")
+        r = yield from o.open(req)
+        self.assertEqual(r.code, 200)
+        self.assertEqual(req.get_header('X-seen'), 'yes')
+
     @async_test
     def test_raise(self):
         # raising URLError stops processing of request
@@ -972,12 +1042,13 @@ class HandlerTests(unittest.TestCase):
 
         for headers in {}, {"Content-Length": 11}:
             req = Request("http://example.com/", iterable_body(), headers)
+            newreq = h.do_request_(req)
             if not headers:
-                # Having an iterable body without a Content-Length should
-                # raise an exception
-                self.assertRaises(ValueError, h.do_request_, req)
+                # An iterable body without a Content-Length is chunked
+                self.assertEqual(newreq.get_header('Transfer-encoding'),
+                                 'chunked')
             else:
-                newreq = h.do_request_(req)
+                self.assertIsNone(newreq.get_header('Transfer-encoding'))
 
         # A file object.
         # Test only Content-Length attribute of request.
@@ -987,14 +1058,22 @@ class HandlerTests(unittest.TestCase):
 
         for headers in {}, {"Content-Length": 30}:
             req = Request("http://example.com/", file_obj, headers)
+            newreq = h.do_request_(req)
             if not headers:
-                # Having an iterable body without a Content-Length should
-                # raise an exception
-                self.assertRaises(ValueError, h.do_request_, req)
+                # a file's size isn't known without a file descriptor
+                self.assertEqual(newreq.get_header('Transfer-encoding'),
+                                 'chunked')
             else:
-                newreq = h.do_request_(req)
                 self.assertEqual(int(newreq.get_header('Content-length')),30)
 
+        # a regular file's size is known
+        with tempfile.TemporaryFile() as file_obj:
+            file_obj.write(b"Something\n" * 3)
+            file_obj.seek(10)
+            req = Request("http://example.com/", file_obj)
+            newreq = h.do_request_(req)
+            self.assertEqual(newreq.get_header('Content-length'), '20')
+
         file_obj.close()
 
         # array.array Iterable - Content Length is calculated
@@ -1006,6 +1085,196 @@ class HandlerTests(unittest.TestCase):
             newreq = h.do_request_(req)
             self.assertEqual(int(newreq.get_header('Content-length')),16)
 
+    @async_test
+    def test_http_streamed_body(self):
+        h = request.AbstractHTTPHandler()
+        h.parent = MockOpener()
+
+        class Blocks:
+            # an asynchronous iterator, usable without async def
+            def __init__(self, blocks):
+                self.blocks = list(blocks)
+            def __aiter__(self):
+                return self
+            @asyncio.coroutine
+            def __anext__(self):
+                yield from asyncio.sleep(0)
+                if not self.blocks:
+                    raise StopAsyncIteration
+                return self.blocks.pop(0)
+
+        for data in (Blocks([b"one", b"", b"three"]),
+                     iter([b"one", b"", b"three"])):
+            req = Request("http://example.com/", data)
+            req.timeout = None
+            http = MockHTTPClass()
+            h.do_request_(req)
+            yield from h.do_open(http, req)
+            self.assertIn(("Transfer-Encoding", "chunked"), http.req_headers)
+            self.assertEqual(b"".join(http.sent),
+                             b"3\r\none\r\n5\r\nthree\r\n0\r\n\r\n")
+
+        # with a Content-Length, blocks are sent as they are
+        req = Request("http://example.com/", io.BytesIO(b"x" * 100),
+                      {"Content-Length": "100"})
+        req.timeout = None
+        http = MockHTTPClass()
+        h.body_blocksize = 64
+        h.do_request_(req)
+        yield from h.do_open(http, req)
+        self.assertEqual(http.sent, [b"x" * 64, b"x" * 36])
+
+    @async_test
+    def test_http_resolve_hosts(self):
+        # off by default; when on, each address is tried in turn
+        self.assertFalse(request.HTTPHandler().resolve_hosts)
+        h = request.AbstractHTTPHandler(resolve_hosts=True)
+        h.parent = MockOpener()
+        attempts = []
+
+        class Connection(MockHTTPClass):
+            def __call__(self, host, timeout=None):
+                attempts.append(host)
+                conn = Connection()
+                conn.host = host
+                return conn
+            @asyncio.coroutine
+            def connect(self):
+                yield None
+                if self.host.startswith("192.0.2.1"):
+                    raise ConnectionRefusedError()
+
+        class Resolver:
+            @asyncio.coroutine
+            def resolve(self, host):
+                yield None
+                return ["192.0.2.1", "2001:db8::1"]
+
+        request.install_resolver(Resolver())
+        self.addCleanup(request.install_resolver, None)
+        req = Request("http://example.com:8080/")
+        req.timeout = None
+        r = yield from h.do_open(Connection(), req)
+        self.assertEqual(r.code, 200)
+        self.assertEqual(attempts, ["192.0.2.1:8080", "[2001:db8::1]:8080"])
+        # HTTPS keeps the name for SNI and certificate checks
+        del attempts[:]
+        req = Request("https://example.com:8443/")
+        req.timeout = None
+        r = yield from h.do_open(Connection(), req)
+        self.assertEqual(attempts, ["example.com:8443"])
+
+    @async_test
+    def test_http_pool(self):
+        h = request.AbstractHTTPHandler(pool=request.HTTPConnectionPool())
+        o = h.parent = MockOpener()
+        req = Request("http://example.com/")
+        req.timeout = None
+        http = MockHTTPClass()
+        yield from h.do_open(http, req)
+        # pooled connections are kept alive
+        self.assertNotIn("Connection", dict(http.req_headers))
+
+    @async_test
+    def test_http_pool_stale_connection(self):
+        conns = []
+        class Response:
+            will_close = False
+            length = 0
+            code = status = 200
+            reason = "OK"
+            def __init__(self):
+                self.fp = MockFile()
+            def _close_conn(self):
+                self.fp = None
+        class Connection:
+            def __init__(self, host, timeout=None):
+                self.sock = object()
+                self.stale = False
+                self.methods = []
+                conns.append(self)
+            @asyncio.coroutine
+            def request(self, method, url, body=None, headers=None):
+                yield None
+                self.methods.append(method)
+            @asyncio.coroutine
+            def getresponse(self):
+                yield None
+                if self.stale:
+                    # the server closed the idle connection
+                    raise client.BadStatusLine("")
+                return Response()
+            def close(self):
+                self.sock = None
+        pool = request.HTTPConnectionPool()
+        h = request.AbstractHTTPHandler(pool=pool)
+        h.parent = MockOpener()
+
+        def open(data=None):
+            req = Request("http://example.com/", data)
+            req.timeout = None
+            return h.do_open(Connection, req)
+
+        r = yield from open()
+        r._close_conn()
+        conns[0].stale = True
+        # a GET on the dropped connection is sent again on a new one
+        r = yield from open()
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(len(conns), 2)
+        self.assertEqual((conns[0].methods, conns[1].methods),
+                         (["GET", "GET"], ["GET"]))
+        r._close_conn()
+        conns[1].stale = True
+        # a POST may have reached the server, so it is not
+        with self.assertRaises(client.BadStatusLine):
+            yield from open(b"data")
+        self.assertEqual(len(conns), 2)
+        self.assertEqual(conns[1].methods, ["GET", "POST"])
+
+    @async_test
+    def test_http_timeouts(self):
+        class SlowHTTPClass(MockHTTPClass):
+            connected = False
+            @asyncio.coroutine
+            def connect(self):
+                yield None
+                self.connected = True
+            @asyncio.coroutine
+            def getresponse(self):
+                yield from asyncio.sleep(1)
+        h = request.AbstractHTTPHandler()
+        h.parent = MockOpener()
+        req = Request("http://example.com/")
+        req.timeout = None
+        req.timeouts = request.Timeouts(connect=1, first_byte=0.01, read=1)
+        http = SlowHTTPClass()
+        with self.assertRaises(socket.timeout):
+            yield from h.do_open(http, req)
+        self.assertTrue(http.connected)
+        # a response class that bounds body reads was asked for
+        self.assertIs(http.response_class, request._TimedHTTPResponse)
+
+    @async_test
+    def test_timed_readline(self):
+        from unittest import mock
+        @asyncio.coroutine
+        def slow_readline(self, limit=-1):
+            yield from asyncio.sleep(1)
+            return b"line\n"
+        r = request._TimedHTTPResponse.__new__(request._TimedHTTPResponse)
+        r.fp = None
+        r.read_timeout = 0.01
+        with mock.patch.object(client.HTTPResponse, "readline",
+                               slow_readline):
+            with self.assertRaises(socket.timeout):
+                yield from r.readline()
+            # the whole-body deadline bounds readline as well
+            r.read_timeout, r.body_deadline = None, time.monotonic()
+            with self.assertRaises(socket.timeout):
+                yield from r.readline()
+        self.assertTrue(r.closed)
+
     def test_http_doubleslash(self):
         # Checks the presence of any unnecessary double slash in url does not
         # break anything. Previously, a double slash directly after the host
@@ -1266,6 +1535,53 @@ class HandlerTests(unittest.TestCase):
         fp = yield from o.open('http://www.example.com')
         self.assertEqual(fp.geturl(), redirected_url.strip())
 
+    @async_test
+    def test_redirect_deadline(self):
+        # every hop of a redirect chain shares one deadline
+        class SlowRedirectHandler(request.BaseHandler):
+            timeouts = []
+            @asyncio.coroutine
+            def http_open(self, req):
+                self.timeouts.append(req.timeout)
+                yield from asyncio.sleep(0.05)
+                n = len(self.timeouts)
+                msg = email.message_from_string(
+                    "Location: http://example.com/%d\r\n\r\n" % n)
+                _r = yield from self.parent.error(
+                    "http", req, MockFile(), 302, "Found", msg)
+                return _r
+        import email
+        sh = SlowRedirectHandler()
+        o = build_test_opener(sh, request.HTTPDefaultErrorHandler(),
+                              request.HTTPRedirectHandler())
+        with self.assertRaises(error.DeadlineExceeded):
+            yield from o.open("http://example.com/", timeout=60,
+                              total_timeout=0.12)
+        self.assertEqual(len(sh.timeouts), 3)
+        self.assertLessEqual(sh.timeouts[0], 0.12)
+        self.assertLess(sh.timeouts[2], sh.timeouts[1])
+        self.assertLess(sh.timeouts[1], sh.timeouts[0])
+
+    @async_test
+    def test_deadline_per_call(self):
+        # a Request can be opened again once its first deadline is past
+        class OKHandler(request.BaseHandler):
+            def http_open(self, req):
+                return MockResponse(200, "OK", {}, "", req.full_url)
+        o = build_test_opener(OKHandler())
+        req = Request("http://example.com/")
+        r = yield from o.open(req, total_timeout=0.01)
+        self.assertEqual(r.code, 200)
+        self.assertIsNone(req.deadline)
+        yield from asyncio.sleep(0.02)
+        r = yield from o.open(req)
+        self.assertEqual(r.code, 200)
+        # a deadline the caller set is kept
+        req.deadline = time.monotonic() - 1
+        with self.assertRaises(error.DeadlineExceeded):
+            yield from o.open(req, total_timeout=60)
+        self.assertLess(req.deadline, time.monotonic())
+
     @async_test
     def test_proxy(self):
         o = OpenerDirector()
@@ -1375,6 +1691,25 @@ class HandlerTests(unittest.TestCase):
         bypass = {'exclude_simple': True, 'exceptions': []}
         self.assertTrue(_proxy_bypass_macosx_sysconf('test', bypass))
 
+    @async_test
+    def test_proxy_bypass_off_loop(self):
+        # platform checks that may resolve names don't run on the loop
+        import threading
+        from unittest import mock
+        threads = []
+        def platform_bypass(host):
+            threads.append(threading.current_thread())
+            return host == "intranet"
+        with mock.patch.object(request, "proxy_bypass", platform_bypass), \
+                support.EnvironmentVarGuard() as env:
+            for name in list(env):
+                if name.lower().endswith("_proxy"):
+                    env.unset(name)
+            self.assertTrue((yield from request._proxy_bypass("intranet")))
+            self.assertFalse((yield from request._proxy_bypass("example.com")))
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
     @async_test
     def test_basic_auth(self, quote_char='"'):
         opener = OpenerDirector()
@@ -1594,6 +1929,940 @@ class HandlerTests(unittest.TestCase):
         _run_with_server(run, b'')
 
 
+class MockPooledConnection:
+    def __init__(self):
+        self.sock = object()
+        self.closed = False
+    def close(self):
+        self.sock = None
+        self.closed = True
+
+class HTTPConnectionPoolTests(unittest.TestCase):
+
+    def test_acquire_release(self):
+        pool = request.HTTPConnectionPool(max_idle_per_host=1)
+        self.assertIsNone(pool.acquire("key"))
+        conn, extra = MockPooledConnection(), MockPooledConnection()
+        pool.release("key", conn)
+        pool.release("key", extra)
+        # beyond max_idle_per_host
+        self.assertTrue(extra.closed)
+        self.assertIs(pool.acquire("key"), conn)
+        self.assertIsNone(pool.acquire("key"))
+        self.assertEqual((pool.hits, pool.misses), (1, 2))
+
+    def test_max_idle_time(self):
+        pool = request.HTTPConnectionPool(max_idle_time=-1)
+        conn = MockPooledConnection()
+        pool.release("key", conn)
+        self.assertIsNone(pool.acquire("key"))
+        self.assertTrue(conn.closed)
+
+    def test_watch(self):
+        class Response:
+            will_close = False
+            length = 0
+            fp = "fp"
+            def _close_conn(self):
+                self.fp = None
+        pool = request.HTTPConnectionPool()
+        conn = MockPooledConnection()
+        r = Response()
+        pool.watch("key", conn, r)
+        r._close_conn()
+        self.assertIsNone(r.fp)
+        self.assertIs(pool.acquire("key"), conn)
+
+        # a response closed before the end of its body is not reused
+        r = Response()
+        r.length = 10
+        pool.watch("key", conn, r)
+        r._close_conn()
+        self.assertTrue(conn.closed)
+        self.assertIsNone(pool.acquire("key"))
+
+    def test_watch_chunked(self):
+        class Response:
+            will_close = False
+            length = None
+            chunked = True
+            closed = False
+            fp = "fp"
+            def _close_conn(self):
+                self.fp = None
+        pool = request.HTTPConnectionPool()
+        # read through the last chunk
+        conn = MockPooledConnection()
+        r = Response()
+        pool.watch("key", conn, r)
+        r._close_conn()
+        self.assertIs(pool.acquire("key"), conn)
+        # closed by the caller part way through
+        r = Response()
+        pool.watch("key", conn, r)
+        r.closed = True
+        r._close_conn()
+        self.assertTrue(conn.closed)
+        self.assertIsNone(pool.acquire("key"))
+
+
+class ConcurrencyLimiterTests(unittest.TestCase):
+
+    class Response(io.BytesIO):
+        # reads from a "connection" that _close_conn lets go of
+        def __init__(self, code, headers, body):
+            import email
+            super().__init__(body)
+            self.code, self.msg = code, "X"
+            self.headers = email.message_from_string(headers + "\n")
+            self.connected = True
+        def info(self):
+            return self.headers
+        def geturl(self):
+            return "http://example.com/"
+        def _close_conn(self):
+            self.connected = False
+        def isclosed(self):
+            return not self.connected
+        def read(self, amt=None):
+            data = super().read(amt)
+            if not data:
+                self._close_conn()
+            return data
+        def close(self):
+            self._close_conn()
+            super().close()
+
+    class OriginHandler(request.BaseHandler):
+        def __init__(self):
+            self.responses = []
+        def http_open(self, req):
+            return ConcurrencyLimiterTests.Response(*self.responses.pop(0))
+
+    def test_per_host_fifo(self):
+        limiter = request.ConcurrencyLimiter(max_per_host=1)
+        order = []
+
+        @asyncio.coroutine
+        def fetch(host, name):
+            yield from limiter.acquire(host)
+            order.append(name)
+            yield from asyncio.sleep(0)
+            limiter.release(host)
+
+        # tasks start in the order they are created
+        tasks = [testLoop.create_task(fetch(host, name)) for host, name in
+                 [("a", "a1"), ("a", "a2"), ("b", "b1"), ("a", "a3")]]
+        testLoop.run_until_complete(asyncio.wait(tasks))
+        self.assertEqual([n for n in order if n.startswith("a")],
+                         ["a1", "a2", "a3"])
+        # "b" was not held up behind the queue for "a"
+        self.assertLess(order.index("b1"), order.index("a2"))
+        self.assertEqual(limiter.acquired, 4)
+        self.assertEqual(limiter.queue_depth(), 0)
+        self.assertEqual(limiter.active, 0)
+
+    def test_total_cap(self):
+        limiter = request.ConcurrencyLimiter(max_total=1)
+
+        @asyncio.coroutine
+        def run():
+            yield from limiter.acquire("a")
+            waiter = testLoop.create_task(limiter.acquire("b"))
+            yield from asyncio.sleep(0)
+            self.assertEqual(limiter.queue_depth(), 1)
+            self.assertEqual(limiter.queue_depth("b"), 1)
+            limiter.release("a")
+            yield from waiter
+            self.assertEqual(limiter.queue_depth(), 0)
+            limiter.release("b")
+
+        testLoop.run_until_complete(run())
+        self.assertGreaterEqual(limiter.max_wait, 0.0)
+
+    def test_slot_held_until_body_read(self):
+        origin = self.OriginHandler()
+        o = OpenerDirector()
+        o.add_handler(origin)
+        o.add_handler(request.HTTPRedirectHandler())
+        o.add_handler(request.HTTPErrorProcessor())
+        o.limiter = limiter = request.ConcurrencyLimiter(max_per_host=1)
+
+        @asyncio.coroutine
+        def run():
+            # a redirect to the same host doesn't wait for its own slot
+            origin.responses = [
+                (302, "Location: http://example.com/b", b"moved"),
+                (200, "", b"body"),
+                (200, "", b"other"),
+                ]
+            r = yield from o.open("http://example.com/a")
+            self.assertEqual(limiter.active, 1)
+            second = testLoop.create_task(o.open("http://example.com/c"))
+            yield from asyncio.sleep(0)
+            self.assertEqual(limiter.queue_depth("example.com"), 1)
+            self.assertEqual(r.read(), b"body")
+            self.assertEqual(r.read(), b"")
+            r = yield from second
+            r.close()
+            self.assertEqual(limiter.active, 0)
+        testLoop.run_until_complete(run())
+
+    @async_test
+    def test_slot_released_for_wrapped_response(self):
+        # the error handlers see the response DecompressionHandler made,
+        # not the one holding the slot
+        import gzip
+        origin = self.OriginHandler()
+        password_manager = MockPasswordManager()
+        auth = request.HTTPBasicAuthHandler(password_manager)
+        password_manager.user, password_manager.password = "user", "pw"
+        o = OpenerDirector()
+        for h in (origin, auth, request.DecompressionHandler(),
+                  request.HTTPErrorProcessor()):
+            o.add_handler(h)
+        o.limiter = limiter = request.ConcurrencyLimiter(max_per_host=1)
+        origin.responses = [
+            (401, 'WWW-Authenticate: Basic realm="r"\n'
+                  'Content-Encoding: gzip', gzip.compress(b"denied")),
+            (200, "Content-Encoding: gzip", gzip.compress(b"ok")),
+            ]
+        r = yield from asyncio.wait_for(o.open("http://example.com/"), 5)
+        self.assertEqual((r.code, (yield from r.read())), (200, b"ok"))
+        r.close()
+        self.assertEqual(limiter.active, 0)
+
+
+class BulkFetchTests(unittest.TestCase):
+
+    urls = ["data:,%d" % i for i in range(5)]
+
+    def test_urlopen_many(self):
+        @asyncio.coroutine
+        def run():
+            results = {}
+            for next_result in request.urlopen_many(self.urls, concurrency=2):
+                url, response = yield from next_result
+                results[url] = response.read()
+            return results
+
+        results = testLoop.run_until_complete(run())
+        self.assertEqual(results, dict((url, url[6:].encode())
+                                       for url in self.urls))
+
+    def test_urlopen_many_errors(self):
+        @asyncio.coroutine
+        def run():
+            results = []
+            for next_result in request.urlopen_many(
+                    ["bogus://example.com/"], errors="return"):
+                results.append((yield from next_result))
+            return results
+
+        [(url, result)] = testLoop.run_until_complete(run())
+        self.assertIsInstance(result, error.URLError)
+        self.assertRaises(ValueError, request.urlopen_many, self.urls,
+                          errors="ignore")
+
+    def test_urlopen_each(self):
+        seen = []
+        def callback(url, response):
+            seen.append(response.read())
+        testLoop.run_until_complete(
+            request.urlopen_each(self.urls, callback, concurrency=2))
+        self.assertEqual(sorted(seen), [b"0", b"1", b"2", b"3", b"4"])
+
+
+class ResolverTests(unittest.TestCase):
+
+    def test_cache(self):
+        from unittest import mock
+        calls = []
+
+        @asyncio.coroutine
+        def getaddrinfo(host, port, **kwargs):
+            calls.append(host)
+            if host == "bad.example.com":
+                raise socket.gaierror(socket.EAI_NONAME, "unknown name")
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                     ("192.0.2.1", 0))]
+
+        @asyncio.coroutine
+        def run(resolver):
+            # concurrent lookups share one query
+            first = yield from asyncio.gather(
+                resolver.resolve("www.example.com"),
+                resolver.resolve("www.example.com"))
+            self.assertEqual(first, [["192.0.2.1"], ["192.0.2.1"]])
+            addr = yield from resolver.gethostbyname("www.example.com")
+            self.assertEqual(addr, "192.0.2.1")
+            # failures are cached too
+            for i in range(2):
+                with self.assertRaises(socket.gaierror):
+                    yield from resolver.resolve("bad.example.com")
+            # addresses need no lookup
+            addr = yield from resolver.resolve("192.0.2.2")
+            self.assertEqual(addr, ["192.0.2.2"])
+
+        with mock.patch.object(testLoop, "getaddrinfo", getaddrinfo):
+            testLoop.run_until_complete(run(request.Resolver()))
+        self.assertEqual(calls, ["www.example.com", "www.example.com",
+                                 "bad.example.com"])
+
+
+class RetryHandlerTests(unittest.TestCase):
+
+    def build(self, outcomes, **kwargs):
+        # each http_open call takes the next outcome: a status code or an
+        # exception to raise
+        class FlakyHandler(request.BaseHandler):
+            def __init__(self):
+                self.calls = 0
+            def http_open(self, req):
+                outcome = outcomes[self.calls]
+                self.calls += 1
+                if isinstance(outcome, Exception):
+                    raise outcome
+                headers = {"Retry-After": "0"} if outcome == 429 else {}
+                return MockResponse(outcome, "", headers, "", req.full_url)
+        kwargs.setdefault("backoff_factor", 0)
+        retry = request.RetryHandler(**kwargs)
+        flaky = FlakyHandler()
+        o = OpenerDirector()
+        o.add_handler(retry)
+        o.add_handler(flaky)
+        return o, retry, flaky
+
+    @async_test
+    def test_retries(self):
+        o, retry, flaky = self.build(
+            [error.URLError("refused"), socket.timeout(), 503, 429, 200],
+            max_retries=4)
+        r = yield from o.open("http://example.com/")
+        self.assertEqual(r.code, 200)
+        self.assertEqual(flaky.calls, 5)
+        self.assertEqual(retry.retries, 4)
+
+    @async_test
+    def test_gives_up(self):
+        o, retry, flaky = self.build([503, 503, 503], max_retries=2)
+        r = yield from o.open("http://example.com/")
+        self.assertEqual((r.code, flaky.calls), (503, 3))
+        # a request may lower its own limit
+        o, retry, flaky = self.build([error.URLError("refused")] * 2)
+        req = Request("http://example.com/")
+        req.max_retries = 0
+        with self.assertRaises(error.URLError):
+            yield from o.open(req)
+        self.assertEqual(flaky.calls, 1)
+
+    @async_test
+    def test_not_idempotent(self):
+        o, retry, flaky = self.build([503, 200])
+        r = yield from o.open("http://example.com/", b"data")
+        self.assertEqual((r.code, flaky.calls), (503, 1))
+
+    @async_test
+    def test_budget(self):
+        o, retry, flaky = self.build([503] * 10, budget_burst=2,
+                                     budget_ratio=0)
+        r = yield from o.open("http://example.com/")
+        self.assertEqual((r.code, flaky.calls), (503, 3))
+        r = yield from o.open("http://example.com/")
+        self.assertEqual(flaky.calls, 4)
+
+    def test_retry_after(self):
+        retry = request.RetryHandler()
+        r = MockResponse(503, "", {"Retry-After": "7"}, "")
+        self.assertEqual(retry.retry_after(r), 7)
+        r.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+        self.assertEqual(retry.retry_after(r), 0)
+        r.headers["Retry-After"] = "soon"
+        self.assertIsNone(retry.retry_after(r))
+
+
+class CircuitBreakerHandlerTests(unittest.TestCase):
+
+    @async_test
+    def test_circuit(self):
+        class FlakyHandler(request.BaseHandler):
+            calls = 0
+            down = True
+            def http_open(self, req):
+                self.calls += 1
+                if self.down:
+                    raise error.URLError("refused")
+                return MockResponse(200, "OK", {}, "", req.full_url)
+        breaker = request.CircuitBreakerHandler(
+            min_requests=3, window=4, reset_timeout=3600)
+        flaky = FlakyHandler()
+        o = OpenerDirector()
+        o.add_handler(breaker)
+        o.add_handler(flaky)
+
+        for i in range(4):
+            with self.assertRaises(error.URLError):
+                yield from o.open("http://example.com/")
+        # the fourth request failed fast
+        self.assertEqual(flaky.calls, 3)
+        self.assertEqual(breaker.state("example.com"), "open")
+        self.assertEqual(breaker.state("example.org"), "closed")
+
+        # a failed probe reopens the circuit, a good one closes it
+        breaker.reset_timeout = 0
+        self.assertEqual(breaker.state("example.com"), "half-open")
+        with self.assertRaises(error.URLError):
+            yield from o.open("http://example.com/")
+        self.assertEqual(flaky.calls, 4)
+        flaky.down = False
+        r = yield from o.open("http://example.com/")
+        self.assertEqual(r.code, 200)
+        self.assertEqual(breaker.state("example.com"), "closed")
+
+    @async_test
+    def test_only_probes_decide(self):
+        class GatedHandler(request.BaseHandler):
+            def __init__(self):
+                self.gates = {}
+            @asyncio.coroutine
+            def http_open(self, req):
+                gate = self.gates[req.selector] = asyncio.Future()
+                code = yield from gate
+                if code is None:
+                    raise error.URLError("refused")
+                return MockResponse(code, "", {}, "", req.full_url)
+        breaker = request.CircuitBreakerHandler(
+            min_requests=1, window=1, reset_timeout=3600)
+        gated = GatedHandler()
+        o = OpenerDirector()
+        o.add_handler(breaker)
+        o.add_handler(gated)
+
+        slow = asyncio.ensure_future(o.open("http://example.com/slow"))
+        failing = asyncio.ensure_future(o.open("http://example.com/fail"))
+        yield from asyncio.sleep(0)
+        gated.gates["/fail"].set_result(None)
+        with self.assertRaises(error.URLError):
+            yield from failing
+        self.assertEqual(breaker.state("example.com"), "open")
+        breaker.reset_timeout = 0
+        probe = asyncio.ensure_future(o.open("http://example.com/probe"))
+        yield from asyncio.sleep(0)
+        # the request sent before the circuit opened does not close it
+        gated.gates["/slow"].set_result(200)
+        yield from slow
+        self.assertEqual(breaker.state("example.com"), "half-open")
+        with self.assertRaises(error.CircuitOpenError):
+            yield from o.open("http://example.com/")
+        gated.gates["/probe"].set_result(503)
+        yield from probe
+        self.assertEqual(breaker._circuits["example.com"].state, "open")
+
+    @async_test
+    def test_open_circuit_not_retried(self):
+        class DownHandler(request.BaseHandler):
+            calls = 0
+            def http_open(self, req):
+                self.calls += 1
+                raise error.URLError("refused")
+        breaker = request.CircuitBreakerHandler(
+            min_requests=1, window=1, reset_timeout=3600)
+        retry = request.RetryHandler(max_retries=3, backoff_factor=0)
+        down = DownHandler()
+        o = OpenerDirector()
+        for h in (retry, breaker, down):
+            o.add_handler(h)
+        # the first attempt opens the circuit and the retry fails fast
+        with self.assertRaises(error.CircuitOpenError) as cm:
+            yield from o.open("http://example.com/")
+        self.assertEqual(cm.exception.host, "example.com")
+        self.assertEqual((down.calls, retry.retries), (1, 1))
+        with self.assertRaises(error.CircuitOpenError):
+            yield from o.open("http://example.com/")
+        self.assertEqual((down.calls, retry.retries), (1, 1))
+
+
+class RateLimitHandlerTests(unittest.TestCase):
+
+    def test_bucket(self):
+        limiter = request.RateLimitHandler(rate=10, burst=2)
+        bucket = limiter.bucket("example.com")
+        self.assertIs(limiter.bucket("example.com"), bucket)
+        self.assertIsNot(limiter.bucket("example.org"), bucket)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # later callers are queued a tenth of a second apart
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+        shared = request.RateLimitHandler(rate=10, per_host=False)
+        self.assertIs(shared.bucket("example.com"),
+                      shared.bucket("example.org"))
+
+    @async_test
+    def test_delay(self):
+        o = OpenerDirector()
+        o.add_handler(request.RateLimitHandler(rate=50))
+        o.add_handler(MockHTTPHandler(200, ""))
+        start = testLoop.time()
+        for i in range(3):
+            yield from o.open("http://example.com/")
+        self.assertGreaterEqual(testLoop.time() - start, 0.03)
+
+    def test_adaptive(self):
+        limiter = request.RateLimitHandler(rate=8, adaptive=True)
+        req = Request("http://example.com/")
+        limiter.http_error_429(req, None, 429, "", {"Retry-After": "5"})
+        bucket = limiter.bucket("example.com")
+        self.assertEqual(bucket.rate, 4)
+        self.assertGreater(bucket.reserve(), 5)
+        limiter.http_response(req, MockResponse(200, "OK", {}, ""))
+        self.assertEqual(bucket.rate, 4.8)
+
+
+class HedgerTests(unittest.TestCase):
+
+    def test_delay(self):
+        hedger = request.Hedger(quantile=0.9, min_samples=10, window=10,
+                                initial_delay=0.5, max_delay=0.08)
+        self.assertEqual(hedger.delay("example.com"), 0.5)
+        for i in range(20):
+            hedger.record("example.com", i / 100)
+        # only the last ten samples count
+        self.assertEqual(hedger.delay("example.com"), 0.08)
+        hedger.max_delay = 1
+        self.assertEqual(hedger.delay("example.com"), 0.18)
+
+    @async_test
+    def test_hedge(self):
+        class SlowFirstHandler(request.BaseHandler):
+            calls = 0
+            cancelled = False
+            @asyncio.coroutine
+            def http_open(self, req):
+                self.calls += 1
+                call = self.calls
+                try:
+                    yield from asyncio.sleep(1 if call == 1 else 0)
+                except asyncio.CancelledError:
+                    self.cancelled = True
+                    raise
+                return MockResponse(200, "OK", {}, str(call), req.full_url)
+        handler = SlowFirstHandler()
+        o = OpenerDirector()
+        o.add_handler(handler)
+        o.hedger = request.Hedger(initial_delay=0.01)
+        r = yield from o.open("http://example.com/")
+        self.assertEqual(r.read(), "2")
+        yield from asyncio.sleep(0)
+        self.assertTrue(handler.cancelled)
+        self.assertEqual((o.hedger.hedged, o.hedger.won), (1, 1))
+        # requests with a body are never sent twice
+        handler.calls = 1
+        r = yield from o.open("http://example.com/", b"data")
+        self.assertEqual((r.read(), handler.calls), ("2", 2))
+
+
+class CoalescingHandlerTests(unittest.TestCase):
+
+    @async_test
+    def test_coalesce(self):
+        class SlowHandler(request.BaseHandler):
+            calls = 0
+            @asyncio.coroutine
+            def http_open(self, req):
+                self.calls += 1
+                yield from asyncio.sleep(0.01)
+                headers = email.message_from_string("Content-type: text/plain\n")
+                return request.addinfourl(io.BytesIO(b"shared body"),
+                                          headers, req.full_url, 200)
+        import email
+        handler = SlowHandler()
+        coalescer = request.CoalescingHandler()
+        o = OpenerDirector()
+        o.add_handler(coalescer)
+        o.add_handler(handler)
+        responses = yield from asyncio.gather(
+            *[o.open("http://example.com/") for i in range(3)])
+        self.assertEqual((handler.calls, coalescer.coalesced), (1, 2))
+        # every caller reads the body on its own
+        for r in responses:
+            self.assertEqual((yield from r.read(6)), b"shared")
+        self.assertEqual((yield from responses[0].read()), b" body")
+        self.assertEqual(responses[1].info()["Content-type"], "text/plain")
+        # a different header or a body means a separate fetch
+        req = Request("http://example.com/", headers={"Accept": "*/*"})
+        yield from asyncio.gather(o.open(req),
+                                  o.open("http://example.com/", b"data"))
+        self.assertEqual(handler.calls, 3)
+        # only the named headers have to match
+        coalescer.key_headers = frozenset(["accept-language"])
+        yield from asyncio.gather(o.open(req), o.open("http://example.com/"))
+        self.assertEqual(handler.calls, 4)
+
+    @async_test
+    def test_stream_and_limit(self):
+        class StreamHandler(request.BaseHandler):
+            def __init__(self):
+                self.responses = []
+            @asyncio.coroutine
+            def http_open(self, req):
+                yield from asyncio.sleep(0.01)
+                r = request.addinfourl(io.BytesIO(b"a large body"),
+                                       email.message.Message(),
+                                       req.full_url, 200)
+                self.responses.append(r)
+                return r
+        import email.message
+        handler = StreamHandler()
+        coalescer = request.CoalescingHandler(max_bytes=4)
+        o = OpenerDirector()
+        o.add_handler(coalescer)
+        o.add_handler(handler)
+        # a request on its own is handed the response unread
+        r = yield from o.open("http://example.com/")
+        self.assertIs(r, handler.responses[0])
+        self.assertEqual(r.fp.tell(), 0)
+        # past max_bytes, the first caller reads on and the others are
+        # sent separately
+        responses = yield from asyncio.gather(
+            *[o.open("http://example.com/") for i in range(3)])
+        self.assertEqual((len(handler.responses), coalescer.coalesced),
+                         (4, 0))
+        sent = [r for r in responses
+                if any(r is other for other in handler.responses)]
+        self.assertEqual([r.fp.tell() for r in sent], [0, 0])
+        first, = [r for r in responses if r not in sent]
+        self.assertEqual((yield from first.read()), b"a large body")
+
+
+class CacheHandlerTests(unittest.TestCase):
+
+    def build(self, storage=None):
+        class OriginHandler(request.BaseHandler):
+            # answers with the status and headers queued in responses, or
+            # raises the exceptions queued there
+            def __init__(self):
+                self.requests = []
+                self.responses = []
+            def http_open(self, req):
+                self.requests.append(req)
+                if isinstance(self.responses[0], Exception):
+                    raise self.responses.pop(0)
+                code, headers, body = self.responses.pop(0)
+                msg = email.message_from_string(headers + "\n")
+                return request.addinfourl(io.BytesIO(body), msg,
+                                          req.full_url, code)
+        import email
+        origin = OriginHandler()
+        cache = request.CacheHandler(storage)
+        o = OpenerDirector()
+        o.add_handler(cache)
+        o.add_handler(origin)
+        return o, cache, origin
+
+    @async_test
+    def test_fresh_and_revalidated(self):
+        o, cache, origin = self.build()
+        url = "http://example.com/"
+        origin.responses = [
+            (200, "Cache-Control: max-age=60", b"fresh"),
+            (200, 'ETag: "1"\nCache-Control: no-cache', b"tagged"),
+            (304, 'ETag: "1"\nX-Checked: yes', b""),
+            ]
+        for i in range(2):
+            r = yield from o.open(url)
+            self.assertEqual((yield from r.read()), b"fresh")
+        self.assertEqual(len(origin.requests), 1)
+        self.assertEqual(r.info()["Age"], "0")
+        # no-cache in the request forces a trip to the origin
+        req = Request(url, headers={"Cache-Control": "no-cache"})
+        r = yield from o.open(req)
+        self.assertEqual((yield from r.read()), b"tagged")
+        r = yield from o.open(url)
+        self.assertEqual(origin.requests[-1].get_header("If-none-match"),
+                         '"1"')
+        self.assertEqual((r.code, r.info()["X-Checked"]), (200, "yes"))
+        self.assertEqual((yield from r.read()), b"tagged")
+        self.assertEqual((cache.hits, cache.misses, cache.revalidated),
+                         (1, 2, 1))
+
+    @async_test
+    def test_not_stored(self):
+        o, cache, origin = self.build()
+        url = "http://example.com/"
+        origin.responses = [
+            (200, "Cache-Control: no-store", b"1"),
+            (200, "Cache-Control: max-age=60\nVary: *", b"2"),
+            (201, "", b"3"),
+            (200, "Cache-Control: max-age=60", b"4"),
+            (200, "", b"5"),
+            ]
+        for i in range(3):
+            yield from o.open(url)
+        self.assertEqual(len(cache.storage._entries), 0)
+        yield from o.open(url)
+        # a successful POST invalidates the entry
+        yield from o.open(url, b"data")
+        self.assertEqual(len(cache.storage._entries), 0)
+        r = yield from o.open(Request(
+            url, headers={"Cache-Control": "only-if-cached"}))
+        self.assertEqual(r.code, 504)
+
+    @async_test
+    def test_range_requests(self):
+        o, cache, origin = self.build()
+        url = "http://example.com/"
+        partial = (206,
+                   "Cache-Control: max-age=60\nContent-Range: bytes 0-1/5",
+                   b"wh")
+        origin.responses = [
+            (200, "Cache-Control: max-age=60", b"whole"), partial, partial]
+        yield from o.open(url)
+        # a range is neither served from the entry nor stored over it
+        for i in range(2):
+            r = yield from o.open(Request(url, headers={"Range": "bytes=0-1"}))
+            self.assertEqual((r.code, r.read()), (206, b"wh"))
+        self.assertEqual(len(origin.requests), 3)
+        r = yield from o.open(url)
+        self.assertEqual((r.code, (yield from r.read())), (200, b"whole"))
+        # nor is a 206 the server sends unasked
+        cache.storage.clear()
+        origin.responses = [(206, "Cache-Control: max-age=60", b"part")]
+        yield from o.open(url)
+        self.assertEqual(len(cache.storage._entries), 0)
+
+    @async_test
+    def test_stale_while_revalidate(self):
+        o, cache, origin = self.build()
+        url = "http://example.com/"
+        origin.responses = [
+            (200, 'ETag: "1"\n'
+                  'Cache-Control: max-age=0, stale-while-revalidate=60',
+             b"old"),
+            (200, 'ETag: "2"\nCache-Control: max-age=60', b"new"),
+            ]
+        yield from o.open(url)
+        r = yield from o.open(url)
+        # served at once, with the origin asked in the background
+        self.assertEqual((yield from r.read()), b"old")
+        self.assertEqual(len(origin.requests), 1)
+        for i in range(3):
+            yield from asyncio.sleep(0)
+        self.assertEqual(origin.requests[1].get_header("If-none-match"),
+                         '"1"')
+        r = yield from o.open(url)
+        self.assertEqual((yield from r.read()), b"new")
+        self.assertEqual((cache.stale, cache.hits), (1, 1))
+
+    @async_test
+    def test_stale_while_revalidate_fresh(self):
+        # a fresh entry the request turns down is not served as stale
+        o, cache, origin = self.build()
+        url = "http://example.com/"
+        origin.responses = [
+            (200, 'Cache-Control: max-age=60, stale-while-revalidate=60',
+             b"old"),
+            (200, 'Cache-Control: max-age=60', b"new"),
+            (200, 'Cache-Control: max-age=60', b"newer"),
+            ]
+        yield from o.open(url)
+        for directive, body in (("max-age=0", b"new"),
+                                ("min-fresh=3600", b"newer")):
+            r = yield from o.open(Request(
+                url, headers={"Cache-Control": directive}))
+            self.assertEqual((yield from r.read()), body)
+        self.assertEqual((cache.stale, len(origin.requests)), (0, 3))
+
+    @async_test
+    def test_stale_if_error(self):
+        o, cache, origin = self.build()
+        url = "http://example.com/"
+        origin.responses = [
+            (200, "Cache-Control: max-age=0, stale-if-error=60", b"old"),
+            (503, "", b"down"),
+            ]
+        yield from o.open(url)
+        r = yield from o.open(url)
+        self.assertEqual((r.code, (yield from r.read())), (200, b"old"))
+        origin.responses = [error.URLError("refused")]
+        r = yield from o.open(url)
+        self.assertEqual((yield from r.read()), b"old")
+        self.assertEqual(cache.stale, 2)
+        # configured bounds win over what the server asked for
+        cache.max_stale_if_error = -1
+        origin.responses = [error.URLError("refused")]
+        with self.assertRaises(error.URLError):
+            yield from o.open(url)
+
+    def test_heuristic_freshness(self):
+        cache = request.CacheHandler()
+        entry = request.CacheEntry(
+            "http://example.com/", 200, "OK",
+            [("Date", "Thu, 11 Jan 2024 00:00:00 GMT"),
+             ("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")],
+            b"", 0, 0)
+        self.assertEqual(cache.freshness_lifetime(entry), 24 * 60 * 60)
+        entry.headers[1] = ("Last-Modified", "Wed, 10 Jan 2024 00:00:00 GMT")
+        self.assertEqual(cache.freshness_lifetime(entry), 8640)
+
+    def test_memory_cache(self):
+        storage = request.MemoryCache(max_entries=2, max_bytes=10)
+        entry = lambda body: request.CacheEntry("u", 200, "OK", [], body,
+                                                0, 0)
+        storage.set("a", entry(b"12345"))
+        storage.set("b", entry(b"12345"))
+        storage.get("a")
+        storage.set("c", entry(b"1"))
+        self.assertIsNone(storage.get("b"))
+        self.assertEqual(storage.size, 6)
+
+    def test_disk_cache(self):
+        import tempfile, shutil
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage = request.DiskCache(directory, max_bytes=1500)
+        entry = request.CacheEntry("http://example.com/", 200, "OK",
+                                   [("ETag", '"1"')], b"x" * 400, 1, 2,
+                                   {"accept": "*/*"})
+        storage.set("a", entry)
+        stored = storage.get("a")
+        self.assertEqual((stored.body, stored.headers, stored.vary),
+                         (entry.body, entry.headers, entry.vary))
+        self.assertEqual(request.DiskCache(directory).size, storage.size)
+        storage.set("b", entry)
+        os.utime(storage._path("a"), (0, 0))
+        storage.set("c", entry)
+        self.assertIsNone(storage.get("a"))
+        self.assertIsNotNone(storage.get("c"))
+        self.assertLessEqual(storage.size, 1500)
+
+    @async_test
+    def test_disk_cache_handler(self):
+        import tempfile, shutil
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        o, cache, origin = self.build(request.DiskCache(directory))
+        origin.responses = [(200, "Cache-Control: max-age=60", b"on disk")]
+        for i in range(2):
+            r = yield from o.open("http://example.com/")
+            self.assertEqual((yield from r.read()), b"on disk")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    @async_test
+    def test_too_big_to_store(self):
+        o, cache, origin = self.build(request.MemoryCache(max_bytes=10))
+        url = "http://example.com/"
+        body = b"x" * 200000
+        origin.responses = [
+            (200, "Cache-Control: max-age=60\nContent-Length: 200000", body),
+            (200, "Cache-Control: max-age=60", body),
+            ]
+        # the Content-Length says it won't fit, so it isn't read at all
+        r = yield from o.open(url)
+        self.assertEqual(r.fp.tell(), 0)
+        self.assertEqual(r.read(), body)
+        # without one, reading stops once the body is past the limit
+        r = yield from o.open(url)
+        self.assertLess(r.fp.fp.tell(), len(body))
+        self.assertEqual((yield from r.read()), body)
+        self.assertEqual(len(cache.storage._entries), 0)
+
+
+class DecompressionHandlerTests(unittest.TestCase):
+
+    def build(self):
+        class OriginHandler(request.BaseHandler):
+            # answers with the status, headers and body queued in responses
+            def __init__(self):
+                self.requests = []
+                self.responses = []
+            def http_open(self, req):
+                self.requests.append(req)
+                code, headers, body = self.responses.pop(0)
+                msg = email.message_from_string(headers + "\n")
+                return request._BufferedHTTPResponse(body, msg, req.full_url,
+                                                     code)
+        import email
+        origin = OriginHandler()
+        o = OpenerDirector()
+        o.add_handler(request.DecompressionHandler())
+        o.add_handler(origin)
+        return o, origin
+
+    @async_test
+    def test_decode(self):
+        import gzip, zlib
+        o, origin = self.build()
+        body = b"spam and eggs\n" * 1000
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        origin.responses = [
+            (200, "Content-Encoding: gzip\nContent-Length: 99",
+             gzip.compress(body)),
+            (200, "Content-Encoding: deflate", zlib.compress(body)),
+            (200, "Content-Encoding: deflate", raw.compress(body) + raw.flush()),
+            (200, "Content-Encoding: deflate, gzip",
+             gzip.compress(zlib.compress(body))),
+            ]
+        for i in range(4):
+            r = yield from o.open("http://example.com/")
+            self.assertEqual((yield from r.readline()), b"spam and eggs\n")
+            self.assertEqual((yield from r.read(4)), b"spam")
+            self.assertEqual((yield from r.read()), body[18:])
+            self.assertIsNone(r.info()["Content-Encoding"])
+            self.assertIsNone(r.info()["Content-Length"])
+        self.assertIn("gzip", origin.requests[0].get_header("Accept-encoding"))
+
+    @async_test
+    def test_left_alone(self):
+        import gzip
+        o, origin = self.build()
+        origin.responses = [
+            (200, "Content-Encoding: compress", b"x"),
+            (206, "Content-Encoding: gzip", b"y"),
+            ]
+        r = yield from o.open("http://example.com/")
+        self.assertEqual((yield from r.read()), b"x")
+        # a range request doesn't ask for an encoding
+        req = Request("http://example.com/", headers={"Range": "bytes=1-"})
+        r = yield from o.open(req)
+        self.assertEqual((yield from r.read()), b"y")
+        self.assertIsNone(origin.requests[1].get_header("Accept-encoding"))
+
+    @async_test
+    def test_truncated(self):
+        import gzip
+        o, origin = self.build()
+        origin.responses = [
+            (200, "Content-Encoding: gzip", gzip.compress(b"x" * 1000)[:-8]),
+            ]
+        r = yield from o.open("http://example.com/")
+        with self.assertRaises(client.IncompleteRead):
+            yield from r.read()
+
+    @async_test
+    def test_bounded(self):
+        # a highly compressed body is only decoded as far as reads go
+        import gzip, zlib
+        o, origin = self.build()
+        body = bytes(16 * 1024 * 1024)
+        origin.responses = [
+            (200, "Content-Encoding: gzip", gzip.compress(body)),
+            (200, "Content-Encoding: deflate, gzip",
+             gzip.compress(zlib.compress(body))),
+            (200, "Content-Encoding: gzip",
+             gzip.compress(b"a" * 100000) + gzip.compress(b"b" * 100000)),
+            ]
+        for i in range(2):
+            r = yield from o.open("http://example.com/")
+            self.assertEqual((yield from r.read(10)), bytes(10))
+            self.assertLessEqual(len(r._buffer), r.decoded_size)
+            self.assertEqual(len((yield from r.read())), len(body) - 10)
+        # the members of a gzip body are drained one after the other
+        r = yield from o.open("http://example.com/")
+        self.assertEqual((yield from r.read()),
+                         b"a" * 100000 + b"b" * 100000)
+
+
 class MiscTests(unittest.TestCase):
 
     def opener_has_handler(self, opener, handler_class):
@@ -1637,6 +2906,70 @@ class MiscTests(unittest.TestCase):
         self.opener_has_handler(o, MyHTTPHandler)
         self.opener_has_handler(o, MyOtherHTTPHandler)
 
+    def test_urlopen_reuses_ssl_opener(self):
+        import ssl
+        context = ssl.create_default_context()
+        request._ssl_opener.cache_clear()
+        for i in range(2):
+            f = testLoop.run_until_complete(
+                request.urlopen("data:,x", context=context))
+            f.close()
+        self.assertEqual(request._ssl_opener.cache_info().hits, 1)
+        request.urlcleanup()
+        self.assertEqual(request._ssl_opener.cache_info().currsize, 0)
+
+    def test_tls_session_cache(self):
+        class FakeSSLObject:
+            def __init__(self, session):
+                self.session_reused = session is not None
+                self.session = session or object()
+        class FakeContext:
+            check_hostname = True
+            def wrap_bio(self, incoming, outgoing, server_side=False,
+                         server_hostname=None, session=None):
+                self.offered = session
+                return FakeSSLObject(session)
+        context = FakeContext()
+        cache = request.TLSSessionCache(maxsize=1)
+        key = ('example.com', 443, context)
+        first = request._ResumingContext(context, cache, key)
+        self.assertTrue(first.check_hostname)
+        first.wrap_bio(None, None, server_hostname='example.com')
+        first.store()
+        self.assertIsNone(context.offered)
+        session = cache.get(key)
+        second = request._ResumingContext(context, cache, key)
+        second.wrap_bio(None, None, server_hostname='example.com')
+        second.store()
+        self.assertIs(context.offered, session)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.put(('example.org', 443, context), object())
+        self.assertIsNone(cache.get(key))
+
+    @async_test
+    def test_tls_session_cache_with_pool(self):
+        import ssl
+        if not hasattr(ssl, 'SSLSession'):
+            self.skipTest('requires ssl.SSLSession')
+        context = ssl.create_default_context()
+        pool = request.HTTPConnectionPool()
+        handler = request.HTTPSHandler(context=context, pool=pool,
+                                       session_cache=request.TLSSessionCache())
+        keys = []
+        @asyncio.coroutine
+        def do_open(http_class, req, **http_conn_args):
+            self.assertIsInstance(http_conn_args['context'],
+                                  request._ResumingContext)
+            keys.append(pool.key(http_class, req, http_conn_args))
+        handler.do_open = do_open
+        for i in range(2):
+            yield from handler.https_open(Request("https://example.com/"))
+        # each connection gets its own session proxy, but they share a key
+        self.assertEqual(keys[0], keys[1])
+        conn = MockPooledConnection()
+        pool.release(keys[0], conn)
+        self.assertIs(pool.acquire(keys[1]), conn)
+
     @unittest.skipUnless(support.is_resource_enabled('network'),
                          'test requires network access')
     @async_test
@@ -1809,6 +3142,17 @@ def test_main(verbose=None):
     tests = (TrivialTests,
              OpenerDirectorTests,
              HandlerTests,
+             HTTPConnectionPoolTests,
+             ConcurrencyLimiterTests,
+             BulkFetchTests,
+             ResolverTests,
+             RetryHandlerTests,
+             CircuitBreakerHandlerTests,
+             RateLimitHandlerTests,
+             HedgerTests,
+             CoalescingHandlerTests,
+             CacheHandlerTests,
+             DecompressionHandlerTests,
              MiscTests,
              RequestTests,
              RequestHdrsTests)
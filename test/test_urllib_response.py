@@ -1,10 +1,16 @@
 """Unit tests for code in urllib.response."""
 
+import asyncio
+import io
 import socket
+import sys
 import tempfile
 import urllib.response
 import unittest
 
+sys.path.insert(1, '../yieldfrom/urllib')
+import response
+
 
 class TestResponse(unittest.TestCase):
 
@@ -56,5 +62,66 @@ class TestResponse(unittest.TestCase):
     def tearDown(self):
         self.sock.close()
 
+
+class TestSlotsResponse(unittest.TestCase):
+
+    def test_slots(self):
+        infourl = response.addinfourl(io.BytesIO(b"spam\neggs"), {},
+                                      "http://www.python.org", 200)
+        self.assertEqual(type(infourl).__dictoffset__, 0)
+        self.assertRaises(AttributeError, setattr, infourl, 'spam', 1)
+        self.assertEqual(infourl.readline(), b"spam\n")
+        # methods not delegated directly still reach the file
+        buf = bytearray(4)
+        self.assertEqual(infourl.readinto(buf), 4)
+        self.assertEqual(buf, b"eggs")
+        self.assertIs(infourl.file, infourl.fp)
+        self.assertRaises(AttributeError, getattr, infourl, 'nonesuch')
+
+    def test_with(self):
+        fp = io.BytesIO(b"")
+        closehook_args = []
+        closehook = response.addclosehook(fp, closehook_args.append, 1)
+        with closehook:
+            pass
+        self.assertTrue(closehook.closed)
+        self.assertEqual(closehook_args, [1])
+        with self.assertRaises(ValueError):
+            with closehook:
+                pass
+
+    def test_iter_lines(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        # a StreamReader has a coroutine read() and no readinto()
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(b"spam\neggs\nha")
+        reader.feed_data(b"m")
+        reader.feed_eof()
+        infourl = response.addinfourl(reader, {}, "http://www.python.org")
+
+        @asyncio.coroutine
+        def collect():
+            it = infourl.iter_lines(size=3)
+            lines = []
+            line = yield from it.next()
+            while line is not None:
+                lines.append(line)
+                line = yield from it.next()
+            return lines
+        lines = loop.run_until_complete(collect())
+        self.assertEqual(lines, [b"spam\n", b"eggs\n", b"ham"])
+
+    def test_readinto(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(b"spam")
+        reader.feed_eof()
+        infourl = response.addinfourl(reader, {}, "http://www.python.org")
+        buf = bytearray(8)
+        count = loop.run_until_complete(infourl.readinto(buf))
+        self.assertEqual(buf[:count], b"spam")
+
 if __name__ == '__main__':
     unittest.main()
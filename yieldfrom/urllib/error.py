@@ -13,7 +13,8 @@ response.
 
 import urllib.response
 
-__all__ = ['URLError', 'HTTPError', 'ContentTooShortError']
+__all__ = ['URLError', 'HTTPError', 'ContentTooShortError', 'DeadlineExceeded',
+           'CircuitOpenError']
 
 
 # do these error classes make sense?
@@ -74,3 +75,14 @@ class ContentTooShortError(URLError):
     def __init__(self, message, content):
         URLError.__init__(self, message)
         self.content = content
+
+# exception raised when a request's total deadline passes
+class DeadlineExceeded(URLError, TimeoutError):
+    def __init__(self, reason='deadline exceeded', filename=None):
+        URLError.__init__(self, reason, filename)
+
+# exception raised when a circuit breaker turns a request away
+class CircuitOpenError(URLError):
+    def __init__(self, host):
+        URLError.__init__(self, 'circuit open for %s' % host)
+        self.host = host
@@ -85,31 +85,42 @@ f = urllib.request.urlopen('http://www.python.org/')
 import base64
 import bisect
 import email
+import email.message
+import email.utils
+import functools
 import hashlib
 #import http.client
 import io
+import json
 import os
 import posixpath
+import random
 import re
 import socket
+import stat
 import sys
 import time
 import collections
 import tempfile
+import threading
 import contextlib
+import copy
 import warnings
+import weakref
 import inspect
 import asyncio
+import zlib
 
 from yieldfrom.http import client
 
-from error import URLError, HTTPError, ContentTooShortError
+from error import (URLError, HTTPError, ContentTooShortError, DeadlineExceeded,
+                   CircuitOpenError)
 from parse import (
     urlparse, urlsplit, urljoin, unwrap, quote, unquote,
     splittype, splithost, splitport, splituser, splitpasswd,
     splitattr, splitquery, splitvalue, splittag, to_bytes,
     unquote_to_bytes, urlunparse)
-from response import addinfourl, addclosehook
+from response import addinfourl, addclosehook, _Streaming, _awaitable
 
 # check for SSL
 try:
@@ -119,20 +130,33 @@ except ImportError:
 else:
     _have_ssl = True
 
+# brotli is optional; br is only asked for when it can be decoded
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 __all__ = [
     # Classes
-    'Request', 'OpenerDirector', 'BaseHandler', 'HTTPDefaultErrorHandler',
-    'HTTPRedirectHandler', 'HTTPCookieProcessor', 'ProxyHandler',
+    'Request', 'Timeouts', 'ConcurrencyLimiter', 'Hedger', 'OpenerDirector',
+    'BaseHandler',
+    'HTTPDefaultErrorHandler', 'HTTPRedirectHandler', 'HTTPCookieProcessor', 'ProxyHandler',
     'HTTPPasswordMgr', 'HTTPPasswordMgrWithDefaultRealm',
     'AbstractBasicAuthHandler', 'HTTPBasicAuthHandler', 'ProxyBasicAuthHandler',
     'AbstractDigestAuthHandler', 'HTTPDigestAuthHandler', 'ProxyDigestAuthHandler',
-    'HTTPHandler', 'FileHandler', 'FTPHandler', 'CacheFTPHandler', 'DataHandler',
-    'UnknownHandler', 'HTTPErrorProcessor',
+    'HTTPConnectionPool', 'HTTPHandler', 'FileHandler', 'FTPHandler',
+    'CacheFTPHandler', 'DataHandler', 'TLSSessionCache',
+    'UnknownHandler', 'CoalescingHandler', 'RetryHandler',
+    'CircuitBreakerHandler', 'RateLimitHandler', 'HTTPErrorProcessor',
+    'Resolver', 'CacheHandler', 'CacheEntry', 'MemoryCache', 'DiskCache',
+    'DecompressionHandler',
     # Functions
-    'urlopen', 'install_opener', 'build_opener',
+    'urlopen', 'urlopen_many', 'urlopen_each', 'install_opener',
+    'build_opener', 'install_resolver',
     'pathname2url', 'url2pathname', 'getproxies',
     # Legacy interface
-    'urlretrieve', 'urlcleanup', 'URLopener', 'FancyURLopener',
+    'urlretrieve', 'urlretrieve_many', 'urlcleanup', 'URLopener',
+    'FancyURLopener',
 ]
 
 # used in User-Agent header sent
@@ -141,7 +165,8 @@ __version__ = sys.version[:3]
 _opener = None
 @asyncio.coroutine
 def urlopen(url, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
-            *, cafile=None, capath=None, cadefault=False, context=None):
+            *, cafile=None, capath=None, cadefault=False, context=None,
+            total_timeout=None, timeouts=None):
     global _opener
     if cafile or capath or cadefault:
         if context is not None:
@@ -151,29 +176,56 @@ def urlopen(url, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
             )
         if not _have_ssl:
             raise ValueError('SSL support not available')
-        context = ssl._create_stdlib_context(cert_reqs=ssl.CERT_REQUIRED,
-                                             cafile=cafile,
-                                             capath=capath)
-        https_handler = HTTPSHandler(context=context, check_hostname=True)
-        opener = build_opener(https_handler)
+        opener = _ssl_opener(cafile, capath, cadefault, None)
     elif context:
-        https_handler = HTTPSHandler(context=context)
-        opener = build_opener(https_handler)
+        opener = _ssl_opener(None, None, False, context)
     elif _opener is None:
         _opener = opener = build_opener()
     else:
         opener = _opener
-    _o = yield from opener.open(url, data, timeout)
+    if total_timeout is None and timeouts is None:
+        _o = yield from opener.open(url, data, timeout)
+    else:
+        _o = yield from opener.open(url, data, timeout,
+                                    total_timeout=total_timeout,
+                                    timeouts=timeouts)
     return _o
 
+# Creating a context loads its CA certificates from disk, and building
+# an opener introspects every handler, so keep the recent ones.
+@functools.lru_cache(maxsize=32)
+def _ssl_opener(cafile, capath, cadefault, context):
+    if context is None:
+        context = ssl._create_stdlib_context(cert_reqs=ssl.CERT_REQUIRED,
+                                             cafile=cafile,
+                                             capath=capath)
+        https_handler = HTTPSHandler(context=context, check_hostname=True)
+    else:
+        https_handler = HTTPSHandler(context=context)
+    return build_opener(https_handler)
+
 def install_opener(opener):
     global _opener
     _opener = opener
 
+_resolver = None
+def install_resolver(resolver):
+    """Install the Resolver shared by all handlers."""
+    global _resolver
+    _resolver = resolver
+
+def _get_resolver():
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver()
+    return _resolver
+
 _url_tempfiles = []
 
 @asyncio.coroutine
-def urlretrieve(url, filename=None, reporthook=None, data=None):
+def urlretrieve(url, filename=None, reporthook=None, data=None, *,
+                conditional=False, resume=False, resume_attempts=5,
+                segments=None, min_segment_size=1024*1024):
     """
     Retrieve a URL into a temporary location on disk.
 
@@ -186,12 +238,65 @@ def urlretrieve(url, filename=None, reporthook=None, data=None):
     If a filename is passed and the URL points to a local resource,
     the result is a copy from local file to new file.
 
+    With conditional set and a filename passed, the response's ETag and
+    Last-Modified are kept in a sidecar file, filename + '.urlmeta'.
+    The next call sends them back as If-None-Match and
+    If-Modified-Since, and if the server answers 304 Not Modified the
+    file on disk is left as it is and returned with the 304's headers.
+
+    With resume set a filename is required.  Whatever is already in the
+    file is kept, and only the rest is asked for, with a Range header
+    guarded by If-Range so a changed resource is fetched whole again.
+    A download cut short is picked up where it stopped, until the file
+    is complete or resume_attempts tries in a row bring no new data.
+
+    With segments set a filename is required.  If the server honours
+    byte ranges, the file is preallocated and up to segments ranges of
+    at least min_segment_size bytes are fetched at once, over separate
+    connections, each written straight to its place in the file and
+    retried on its own if it fails.  Otherwise the body is downloaded
+    in one stream as usual.
+
     Returns a tuple containing the path to the newly created
     data file as well as the resulting HTTPMessage object.
     """
+    if resume:
+        if not filename or data is not None:
+            raise ValueError("resume needs a filename and no data")
+        _r = yield from _retrieve_resuming(url, filename, reporthook,
+                                           resume_attempts)
+        return _r
+    if segments:
+        if not filename or data is not None:
+            raise ValueError("segments needs a filename and no data")
+        _r = yield from _retrieve_segmented(url, filename, reporthook,
+                                            segments, min_segment_size,
+                                            resume_attempts)
+        return _r
+
     url_type, path = splittype(url)
 
-    _u = yield from urlopen(url, data)
+    meta = None
+    if conditional and filename and data is None:
+        meta = _read_urlmeta(filename, url)
+        if meta and meta.get('partial'):
+            meta = None
+    if meta:
+        req = Request(url)
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            _u = yield from urlopen(req)
+        except HTTPError as err:
+            if err.code != 304:
+                raise
+            if err.fp is not None:
+                err.close()
+            return filename, err.headers
+    else:
+        _u = yield from urlopen(url, data)
     with contextlib.closing(_u) as fp:
         headers = fp.info()
 
@@ -202,6 +307,9 @@ def urlretrieve(url, filename=None, reporthook=None, data=None):
 
         # Handle temporary file setup.
         if filename:
+            if conditional:
+                # until the body is all in, the file matches no validators
+                _write_urlmeta(filename, url, headers, partial=True)
             tfp = open(filename, 'wb')
         else:
             tfp = tempfile.NamedTemporaryFile(delete=False)
@@ -210,36 +318,557 @@ def urlretrieve(url, filename=None, reporthook=None, data=None):
 
         with tfp:
             result = filename, headers
-            bs = 1024*8
-            size = -1
-            read = 0
-            blocknum = 0
-            if "content-length" in headers:
-                size = int(headers["Content-Length"])
-
-            if reporthook:
-                reporthook(blocknum, bs, size)
-
-            while True:
-                if type(fp) in (asyncio.StreamReader, client.HTTPResponse):
-                    block = yield from fp.read(bs)
-                else:
-                    block = fp.read(bs)
-                if not block:
-                    break
-                read += len(block)
-                tfp.write(block)
-                blocknum += 1
-                if reporthook:
-                    reporthook(blocknum, bs, size)
+            read, size = yield from _copy_response(fp, tfp, reporthook)
 
     if size >= 0 and read < size:
         raise ContentTooShortError(
             "retrieval incomplete: got only %i out of %i bytes"
             % (read, size), result)
 
+    if conditional and filename:
+        _write_urlmeta(filename, url, headers)
+
     return result
 
+@asyncio.coroutine
+def _pump(fp, write, length=None, bs=1024*8, max_bs=1024*1024,
+          max_pending=4, progress=None):
+    """Read the body of response fp and pass it to write() in blocks.
+
+    Blocks are read with readinto() where fp has it, into buffers that
+    are reused once written, and grow from bs up to max_bs while the
+    body keeps filling them.  write runs in order on the default
+    executor, so a slow disk doesn't stall the event loop; at most
+    max_pending filled buffers wait for the disk before reading pauses.
+    At most length bytes are read, if given.  progress is called on the
+    loop with the size of each block read.
+
+    Returns the number of bytes read.
+    """
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=max_pending)
+    free = []
+    error = None
+    read = 0
+
+    @asyncio.coroutine
+    def write_all():
+        # keep draining after a failure, so the reader never blocks on
+        # a full queue
+        nonlocal error
+        while True:
+            item = yield from queue.get()
+            if item is None:
+                return
+            data, buf = item
+            if error is None:
+                try:
+                    yield from loop.run_in_executor(None, write, data)
+                except Exception as exc:
+                    error = exc
+            if buf is not None:
+                free.append(buf)
+
+    writer = loop.create_task(write_all())
+    readinto = getattr(fp, 'readinto', None)
+    n = bs
+    try:
+        while error is None:
+            want = n if length is None else min(n, length - read)
+            if want <= 0:
+                break
+            if readinto is not None:
+                buf = free.pop() if free else None
+                if buf is None or len(buf) < want:
+                    buf = bytearray(n)
+                view = memoryview(buf)[:want]
+                count = readinto(view)
+                awaitable = _awaitable(count)
+                if awaitable is not None:
+                    count = yield from awaitable
+                if not count:
+                    break
+                data = view[:count]
+            else:
+                buf = None
+                data = fp.read(want)
+                awaitable = _awaitable(data)
+                if awaitable is not None:
+                    data = yield from awaitable
+                if not data:
+                    break
+                count = len(data)
+            read += count
+            yield from queue.put((data, buf))
+            if count == n and n < max_bs:
+                n = min(n * 2, max_bs)
+            if progress:
+                progress(count)
+    finally:
+        # the file mustn't be closed under a write still running on a
+        # thread
+        yield from queue.put(None)
+        yield from asyncio.wait([writer])
+    if error is not None:
+        raise error
+    return read
+
+@asyncio.coroutine
+def _copy_response(fp, tfp, reporthook=None, bs=1024*8, max_bs=1024*1024,
+                   max_pending=4):
+    """Copy the body of response fp into file tfp.
+
+    The copy goes through _pump(), so reads don't wait on the disk.
+    reporthook is given bs as the block size, with block numbers
+    counting bs-sized blocks.
+
+    Returns the number of bytes copied and the Content-Length of the
+    response, -1 if it has none.
+    """
+    headers = fp.info()
+    size = -1
+    read = 0
+    if "content-length" in headers:
+        size = int(headers["Content-Length"])
+
+    if reporthook:
+        reporthook(0, bs, size)
+
+    def progress(count):
+        nonlocal read
+        read += count
+        reporthook(-(-read // bs), bs, size)
+
+    read = yield from _pump(fp, tfp.write, bs=bs, max_bs=max_bs,
+                            max_pending=max_pending,
+                            progress=progress if reporthook else None)
+    return read, size
+
+@asyncio.coroutine
+def _retrieve_resuming(url, filename, reporthook, attempts):
+    """Download url into filename, resuming from what it already holds.
+
+    The validators in the '.urlmeta' sidecar tie the bytes on disk to a
+    version of the resource; without them the download starts over.
+    """
+    if attempts < 1:
+        raise ValueError("resume_attempts must be at least 1")
+    failures = 0
+    while True:
+        meta = _read_urlmeta(filename, url)
+        validator = None
+        if meta:
+            etag = meta.get('etag')
+            if etag and not etag.startswith('W/'):
+                validator = etag
+            else:
+                validator = meta.get('last_modified')
+        try:
+            previous = os.path.getsize(filename)
+        except OSError:
+            previous = 0
+        offset = previous if validator else 0
+        req = Request(url)
+        if offset:
+            req.add_header('Range', 'bytes=%d-' % offset)
+            req.add_header('If-Range', validator)
+        try:
+            try:
+                fp = yield from urlopen(req)
+            except HTTPError as err:
+                if err.code != 416 or not offset:
+                    raise
+                if err.fp is not None:
+                    err.close()
+                # Nothing past offset: done if that is the whole resource.
+                start, end, total = _parse_content_range(
+                    err.headers.get('Content-Range'))
+                if total == offset:
+                    _write_urlmeta(filename, url,
+                                   {'ETag': meta.get('etag'),
+                                    'Last-Modified': meta.get('last_modified')})
+                    return filename, err.headers
+                os.unlink(filename)
+                continue
+            with contextlib.closing(fp):
+                headers = fp.info()
+                total = -1
+                if fp.getcode() == 206:
+                    start, end, total = _parse_content_range(
+                        headers.get('Content-Range'))
+                    if start != offset:
+                        raise URLError('unexpected Content-Range %r for '
+                                       'offset %d'
+                                       % (headers.get('Content-Range'), offset))
+                    if total is None:
+                        total = -1
+                    mode = 'ab'
+                else:
+                    offset = 0
+                    mode = 'wb'
+                    if "content-length" in headers:
+                        total = int(headers["Content-Length"])
+                _write_urlmeta(filename, url, headers, partial=True)
+                with open(filename, mode) as tfp:
+                    tfp.seek(offset)
+                    tfp.truncate()
+                    read, size = yield from _copy_response(fp, tfp,
+                                                           reporthook)
+        except HTTPError:
+            raise
+        except (OSError, client.HTTPException) as exc:
+            error = exc
+        else:
+            if size < 0 or read >= size:
+                if total < 0 or offset + read >= total:
+                    _write_urlmeta(filename, url, headers)
+                    return filename, headers
+            error = ContentTooShortError(
+                "retrieval incomplete: got only %i out of %i bytes"
+                % (offset + read, total), (filename, headers))
+        # Only a file that grew is progress: a server that ignores Range
+        # sends the start again, which may stop short of it every time.
+        try:
+            grew = os.path.getsize(filename) > previous
+        except OSError:
+            grew = False
+        failures = 0 if grew else failures + 1
+        if failures >= attempts:
+            raise error
+        if failures:
+            yield from asyncio.sleep(min(0.5 * 2 ** (failures - 1), 30))
+
+def _parse_content_range(value):
+    """Return (first, last, complete length) from a Content-Range value.
+
+    Parts not given are None, and all three are None if value can't be
+    parsed.
+    """
+    m = re.match(r'bytes\s+(?:(\d+)-(\d+)|\*)/(?:(\d+)|\*)\s*$',
+                 value or '', re.I)
+    if not m:
+        return None, None, None
+    return tuple(int(v) if v is not None else None for v in m.groups())
+
+_seek_lock = threading.Lock()
+
+def _pwrite(fd, data, offset):
+    """Write all of data to fd at offset, leaving the file position be."""
+    data = memoryview(data)
+    while data:
+        if hasattr(os, 'pwrite'):
+            n = os.pwrite(fd, data, offset)
+        else:
+            # the file position is shared with writes on other threads
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, data)
+        data = data[n:]
+        offset += n
+
+class _PositionedWriter:
+    """write() to fd at offset, moving offset on past what was written."""
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        _pwrite(self.fd, data, self.offset)
+        self.offset += len(data)
+
+@asyncio.coroutine
+def _retrieve_segmented(url, filename, reporthook, segments,
+                        min_segment_size, attempts, bs=1024*64):
+    """Download url into filename as concurrent byte range requests.
+
+    A one byte range request probes for range support and the length;
+    a server answering it with the whole body gets a plain download.
+    The headers returned are the probe's, made to describe the whole
+    resource: Content-Length is its full size and Content-Range is gone.
+    """
+    if segments < 1 or attempts < 1:
+        raise ValueError("segments and attempts must be at least 1")
+    probe = Request(url)
+    probe.add_header('Range', 'bytes=0-0')
+    try:
+        fp = yield from urlopen(probe)
+    except HTTPError as err:
+        if err.code != 416:
+            raise
+        # an empty resource has no byte 0
+        if err.fp is not None:
+            err.close()
+        _r = yield from urlretrieve(url, filename, reporthook)
+        return _r
+    with contextlib.closing(fp):
+        headers = fp.info()
+        total = None
+        if fp.getcode() == 206:
+            total = _parse_content_range(headers.get('Content-Range'))[2]
+        if total is None:
+            if fp.getcode() == 206:
+                # a range we can't size: fall back to a single stream
+                fp.close()
+                _r = yield from urlretrieve(url, filename, reporthook)
+                return _r
+            with open(filename, 'wb') as tfp:
+                read, size = yield from _copy_response(fp, tfp, reporthook)
+            if size >= 0 and read < size:
+                raise ContentTooShortError(
+                    "retrieval incomplete: got only %i out of %i bytes"
+                    % (read, size), (filename, headers))
+            return filename, headers
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        validator = etag
+    else:
+        validator = headers.get('Last-Modified')
+    headers = copy.deepcopy(headers)
+    del headers['Content-Range']
+    del headers['Content-Length']
+    headers['Content-Length'] = str(total)
+
+    count = max(1, min(segments, total // max(min_segment_size, 1)))
+    bounds = [total * i // count for i in range(count + 1)]
+    done = 0
+    if reporthook:
+        reporthook(0, bs, total)
+
+    def progress(count):
+        nonlocal done
+        done += count
+        reporthook(-(-done // bs), bs, total)
+
+    @asyncio.coroutine
+    def fetch(fd, start, end):
+        failures = 0
+        while start < end:
+            req = Request(url)
+            req.add_header('Range', 'bytes=%d-%d' % (start, end - 1))
+            if validator:
+                req.add_header('If-Range', validator)
+            out = _PositionedWriter(fd, start)
+            error = None
+            try:
+                fp = yield from urlopen(req)
+                with contextlib.closing(fp):
+                    first = _parse_content_range(
+                        fp.info().get('Content-Range'))[0]
+                    if fp.getcode() != 206 or first != start:
+                        raise URLError('%s changed during a segmented '
+                                       'download' % url)
+                    yield from _pump(fp, out.write, end - start, bs=bs,
+                                     progress=progress if reporthook
+                                     else None)
+            except URLError as exc:
+                # HTTP errors and a changed resource won't go away on a
+                # retry; a failure to connect might
+                if isinstance(exc.reason, str):
+                    raise
+                error = exc
+            except (OSError, client.HTTPException) as exc:
+                error = exc
+            # whatever reached the disk is kept, even after a failure
+            before, start = start, out.offset
+            if start >= end:
+                break
+            if error is None:
+                error = ContentTooShortError(
+                    "retrieval incomplete: segment ended at %i of %i"
+                    % (start, end), (filename, headers))
+            failures = 0 if start > before else failures + 1
+            if failures >= attempts:
+                raise error
+            if failures:
+                yield from asyncio.sleep(min(0.5 * 2 ** (failures - 1), 30))
+
+    loop = asyncio.get_event_loop()
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC |
+                 getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        os.truncate(fd, total)
+        tasks = [loop.create_task(fetch(fd, bounds[i], bounds[i + 1]))
+                 for i in range(count)]
+        try:
+            finished, pending = yield from asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if pending:
+            yield from asyncio.wait(pending)
+        errors = [task.exception() for task in finished if task.exception()]
+        if errors:
+            raise errors[0]
+    except BaseException:
+        os.close(fd)
+        with contextlib.suppress(OSError):
+            os.unlink(filename)
+        raise
+    os.close(fd)
+    return filename, headers
+
+def _read_urlmeta(filename, url):
+    """Return the validators saved for filename, if they are for url."""
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename + '.urlmeta', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(meta, dict) or meta.get('url') != url:
+        return None
+    return meta
+
+def _write_urlmeta(filename, url, headers, **extra):
+    """Save the validators in headers next to filename.
+
+    The sidecar file is replaced atomically; it is removed when the
+    response carries no validators.
+    """
+    metaname = filename + '.urlmeta'
+    meta = {'url': url, 'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified')}
+    meta.update(extra)
+    if not (meta['etag'] or meta['last_modified']):
+        with contextlib.suppress(OSError):
+            os.unlink(metaname)
+        return
+    tmpname = metaname + '.tmp'
+    with open(tmpname, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmpname, metaname)
+
+def _bounded_as_completed(fetch, items, concurrency, errors):
+    """Run fetch(item) over items, at most concurrency at a time.
+
+    Yields coroutines that each return the next (item, result) pair to
+    complete.  items is consumed lazily, as slots free up.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    if errors not in ('raise', 'return'):
+        raise ValueError("errors must be 'raise' or 'return', not %r"
+                         % (errors,))
+    loop = asyncio.get_event_loop()
+    items = iter(items)
+    pending = set()
+
+    @asyncio.coroutine
+    def run(item):
+        try:
+            result = yield from fetch(item)
+        except Exception as exc:
+            if errors == 'raise':
+                raise
+            result = exc
+        return item, result
+
+    def fill():
+        while len(pending) < concurrency:
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            pending.add(loop.create_task(run(item)))
+
+    @asyncio.coroutine
+    def next_done():
+        done, _ = yield from asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED)
+        task = done.pop()
+        pending.remove(task)
+        fill()
+        return task.result()
+
+    def iterate():
+        fill()
+        try:
+            while pending:
+                yield next_done()
+        finally:
+            # the consumer stopped early; don't leave fetches running
+            for task in pending:
+                task.cancel()
+    return iterate()
+
+def urlopen_many(urls, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 *, concurrency=10, errors='raise'):
+    """Open many URLs, at most concurrency at a time.
+
+    urls is an iterable of URLs or Request objects, consumed lazily.
+    Like asyncio.as_completed(), this returns an iterator of coroutines,
+    each returning the next (url, response) pair to complete:
+
+        for next_result in urlopen_many(urls, concurrency=20):
+            url, response = yield from next_result
+
+    Each coroutine must be waited for before the next is taken.  With
+    errors='raise' a failed fetch raises from its coroutine; with
+    errors='return' the exception is returned in place of the response.
+    """
+    @asyncio.coroutine
+    def fetch(url):
+        _r = yield from urlopen(url, data, timeout)
+        return _r
+    return _bounded_as_completed(fetch, urls, concurrency, errors)
+
+def urlretrieve_many(urls, *, concurrency=10, errors='raise',
+                     conditional=False):
+    """Retrieve many URLs to disk, at most concurrency at a time.
+
+    urls is an iterable of URLs or (url, filename) pairs, consumed
+    lazily.  Returns an iterator of coroutines, as urlopen_many() does,
+    each returning the next (url, (filename, headers)) pair to complete.
+    conditional is passed on to urlretrieve().
+    """
+    @asyncio.coroutine
+    def fetch(item):
+        if isinstance(item, tuple):
+            url, filename = item
+        else:
+            url, filename = item, None
+        _r = yield from urlretrieve(url, filename, conditional=conditional)
+        return _r
+    return _bounded_as_completed(fetch, urls, concurrency, errors)
+
+@asyncio.coroutine
+def urlopen_each(urls, callback, data=None,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 *, concurrency=10, errors='raise'):
+    """Stream responses for urls through callback(url, response).
+
+    At most concurrency URLs are fetched at a time.  callback may be a
+    plain function or a coroutine; it runs as soon as its response
+    arrives, and the response is closed when it returns, so no more than
+    concurrency responses are held at once.  With errors='return' the
+    callback receives the exception in place of a failed response.
+    """
+    if errors not in ('raise', 'return'):
+        raise ValueError("errors must be 'raise' or 'return', not %r"
+                         % (errors,))
+
+    @asyncio.coroutine
+    def fetch(url):
+        try:
+            response = yield from urlopen(url, data, timeout)
+        except Exception as exc:
+            if errors == 'raise':
+                raise
+            response = exc
+        try:
+            result = callback(url, response)
+            if inspect.isgenerator(result) or asyncio.iscoroutine(result):
+                yield from result
+        finally:
+            if not isinstance(response, Exception):
+                response.close()
+
+    for next_done in _bounded_as_completed(fetch, urls, concurrency, 'raise'):
+        yield from next_done
+
 def urlcleanup():
     for temp_file in _url_tempfiles:
         try:
@@ -251,6 +880,7 @@ def urlcleanup():
     global _opener
     if _opener:
         _opener = None
+    _ssl_opener.cache_clear()
 
 # copied from cookielib.py
 _cut_port_re = re.compile(r":\d+$", re.ASCII)
@@ -270,8 +900,31 @@ def request_host(request):
     host = _cut_port_re.sub("", host, 1)
     return host.lower()
 
+Timeouts = collections.namedtuple('Timeouts', 'connect tls first_byte read body')
+Timeouts.__new__.__defaults__ = (None,) * len(Timeouts._fields)
+Timeouts.__doc__ = """Limits in seconds on each phase of an HTTP exchange.
+
+connect bounds setting up a new connection and tls its TLS handshake.
+The handshake is not timed on its own: over HTTPS the connection class
+does both inside one connect() call, so tls is added to connect and
+the sum bounds that call.  first_byte bounds the wait for the response
+headers once the request is sent, read bounds each read or readline
+of the body and body the whole of it, counted from the arrival of the headers.  None means no limit
+beyond the request's timeout.
+"""
+
+_NO_TIMEOUTS = Timeouts()
+
+
 class Request:
 
+    # per-phase Timeouts for HTTP requests
+    timeouts = None
+
+    # time.monotonic() value by which the request, including redirects
+    # and authentication retries, must be answered
+    deadline = None
+
     def __init__(self, url, data=None, headers={},
                  origin_req_host=None, unverifiable=False,
                  method=None):
@@ -380,6 +1033,202 @@ class Request:
         hdrs.update(self.headers)
         return list(hdrs.items())
 
+class ConcurrencyLimiter:
+    """Global and per-host caps on concurrent requests, with FIFO queuing.
+
+    A request over either cap waits until a slot is released; waiters
+    for a host are served in arrival order, and a host at its cap does
+    not hold up waiters for other hosts.  queue_depth() and the wait
+    statistics (total_wait, max_wait, mean_wait) show how much the caps
+    are delaying requests.
+    """
+
+    def __init__(self, max_total=None, max_per_host=None):
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        self.active = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._active_hosts = collections.Counter()
+        self._waiting_hosts = collections.Counter()
+        self._waiters = collections.deque()
+
+    def _available(self, host):
+        return ((self.max_total is None or self.active < self.max_total) and
+                (self.max_per_host is None or
+                 self._active_hosts[host] < self.max_per_host))
+
+    def _grant(self, host):
+        self.active += 1
+        self._active_hosts[host] += 1
+        self.acquired += 1
+
+    def queue_depth(self, host=None):
+        """Return the number of waiting requests, for one host or all."""
+        if host is None:
+            return len(self._waiters)
+        return self._waiting_hosts[host]
+
+    @property
+    def mean_wait(self):
+        if not self.acquired:
+            return 0.0
+        return self.total_wait / self.acquired
+
+    @asyncio.coroutine
+    def acquire(self, host):
+        if self._available(host) and not self._waiting_hosts[host]:
+            self._grant(host)
+            return
+        start = time.monotonic()
+        waiter = (host, asyncio.Future())
+        self._waiters.append(waiter)
+        self._waiting_hosts[host] += 1
+        try:
+            yield from waiter[1]
+        except asyncio.CancelledError:
+            if waiter[1].cancelled():
+                self._waiters.remove(waiter)
+                self._waiting_hosts[host] -= 1
+            else:
+                # the slot was handed over just before the cancellation
+                self.release(host)
+            raise
+        wait = time.monotonic() - start
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def release(self, host):
+        self.active -= 1
+        self._active_hosts[host] -= 1
+        if not self._active_hosts[host]:
+            del self._active_hosts[host]
+        for waiter in list(self._waiters):
+            if self.max_total is not None and self.active >= self.max_total:
+                break
+            host, fut = waiter
+            if fut.done() or not self._available(host):
+                continue
+            self._waiters.remove(waiter)
+            self._waiting_hosts[host] -= 1
+            if not self._waiting_hosts[host]:
+                del self._waiting_hosts[host]
+            self._grant(host)
+            fut.set_result(None)
+
+
+class Hedger:
+    """Latency-tuned hedging of idempotent requests.
+
+    When an OpenerDirector has a hedger, a GET or HEAD request that has
+    not got its response headers after delay(host) seconds is sent a
+    second time; whichever copy answers first is used and the other is
+    cancelled, its connection closed.  The delay is the quantile of the
+    last window header latencies seen for the host, kept between
+    min_delay and max_delay; until min_samples are in, initial_delay is
+    used.  hedged counts the requests sent twice and won those where
+    the second copy answered first.
+    """
+
+    def __init__(self, quantile=0.95, window=100, min_samples=20,
+                 initial_delay=1.0, min_delay=0.01, max_delay=5.0):
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.hedged = 0
+        self.won = 0
+        self._latencies = {}
+
+    def record(self, host, latency):
+        samples = self._latencies.get(host)
+        if samples is None:
+            samples = self._latencies[host] = collections.deque(
+                maxlen=self.window)
+        samples.append(latency)
+
+    def delay(self, host):
+        samples = self._latencies.get(host)
+        if samples is None or len(samples) < self.min_samples:
+            return self.initial_delay
+        ordered = sorted(samples)
+        delay = ordered[int(self.quantile * (len(ordered) - 1))]
+        return min(max(delay, self.min_delay), self.max_delay)
+
+    @asyncio.coroutine
+    def open(self, req, open_copy):
+        """Return the first response from open_copy(req) or its hedge.
+
+        open_copy is a coroutine function run on req and, if that is slow,
+        on a copy of it.
+        """
+        host = req.host
+        start = time.monotonic()
+        first = asyncio.get_event_loop().create_task(open_copy(req))
+        try:
+            yield from asyncio.wait([first], timeout=self.delay(host))
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        if first.done():
+            response = first.result()
+            self.record(host, time.monotonic() - start)
+            return response
+
+        self.hedged += 1
+        hedge_start = time.monotonic()
+        second = asyncio.get_event_loop().create_task(
+            open_copy(_copy_request(req)))
+        pending = {first, second}
+        try:
+            while True:
+                done, pending = yield from asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in (first, second):
+                    if task in done and task.exception() is None:
+                        winner = task
+                        break
+                if winner is not None or not pending:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        if winner is None:
+            # both copies failed; report the original's error
+            return first.result()
+        loser = second if winner is first else first
+        if loser.done() and not loser.cancelled() and \
+                loser.exception() is None and loser.result() is not None:
+            loser.result().close()
+        if winner is second:
+            self.won += 1
+            self.record(host, time.monotonic() - hedge_start)
+        else:
+            self.record(host, time.monotonic() - start)
+        return winner.result()
+
+
+def _copy_request(req):
+    new = copy.copy(req)
+    new.headers = dict(req.headers)
+    new.unredirected_hdrs = dict(req.unredirected_hdrs)
+    return new
+
+
+def _compile_chain(handlers, meth_name):
+    """Bind meth_name on each handler, noting which are coroutines."""
+    methods = []
+    for handler in handlers:
+        func = getattr(handler, meth_name)
+        is_coroutine = (asyncio.iscoroutinefunction(func) or
+                        inspect.isgeneratorfunction(func))
+        methods.append((func, is_coroutine))
+    return tuple(methods)
+
 class OpenerDirector:
     def __init__(self):
         client_version = "Python-urllib/%s" % __version__
@@ -391,6 +1240,18 @@ class OpenerDirector:
         self.handle_error = {}
         self.process_response = {}
         self.process_request = {}
+        # bound methods for each chain, compiled by add_handler in handler
+        # order, paired with whether the method is a coroutine function
+        self._open_methods = {}
+        self._error_methods = {}
+        self._request_methods = {}
+        self._response_methods = {}
+        # set to a ConcurrencyLimiter to cap requests in flight
+        self.limiter = None
+        # responses still holding a limiter slot, and its release
+        self._held = weakref.WeakKeyDictionary()
+        # set to a Hedger to send slow GET and HEAD requests twice
+        self.hedger = None
 
     def add_handler(self, handler):
         if not hasattr(handler, "add_parent"):
@@ -416,15 +1277,19 @@ class OpenerDirector:
                     pass
                 lookup = self.handle_error.get(protocol, {})
                 self.handle_error[protocol] = lookup
+                compiled, key = self._error_methods, meth
             elif condition == "open":
                 kind = protocol
                 lookup = self.handle_open
+                compiled, key = self._open_methods, kind
             elif condition == "response":
                 kind = protocol
                 lookup = self.process_response
+                compiled, key = self._response_methods, kind
             elif condition == "request":
                 kind = protocol
                 lookup = self.process_request
+                compiled, key = self._request_methods, kind
             else:
                 continue
 
@@ -433,6 +1298,7 @@ class OpenerDirector:
                 bisect.insort(handlers, handler)
             else:
                 handlers.append(handler)
+            compiled[key] = _compile_chain(handlers, meth)
             added = True
 
         if added:
@@ -448,17 +1314,30 @@ class OpenerDirector:
         # Handlers raise an exception if no one else should try to handle
         # the request, or return None if they can't but another handler
         # could.  Otherwise, they return the response.
-        handlers = chain.get(kind, ())
-        for handler in handlers:
-            func = getattr(handler, meth_name)
+        if chain is self.handle_open:
+            methods = self._open_methods.get(kind, ())
+        else:
+            methods = self._error_methods.get(meth_name, ())
+        _r = yield from self._run_methods(methods, *args)
+        return _r
+
+    @asyncio.coroutine
+    def _run_methods(self, methods, *args):
+        for func, is_coroutine in methods:
             result = func(*args)
-            if inspect.isgenerator(result):
+            if is_coroutine:
                 result = yield from result
+            else:
+                # plain methods may still hand back something to wait on
+                awaitable = _awaitable(result)
+                if awaitable is not None:
+                    result = yield from awaitable
             if result is not None:
                 return result
 
     @asyncio.coroutine
-    def open(self, fullurl, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    def open(self, fullurl, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+             *, total_timeout=None, timeouts=None):
         # accept a URL or a Request object
         if isinstance(fullurl, str):
             req = Request(fullurl, data)
@@ -467,29 +1346,133 @@ class OpenerDirector:
             if data is not None:
                 req.data = data
 
-        req.timeout = timeout
-        protocol = req.type
+        if timeouts is not None:
+            req.timeouts = timeouts
+        # the deadline is this call's alone; only the hops made inside it
+        # (redirects, auth retries) see it
+        owner, previous = req, req.deadline
+        if total_timeout is not None:
+            deadline = time.monotonic() + total_timeout
+            if req.deadline is None or deadline < req.deadline:
+                req.deadline = deadline
+        try:
+            if req.deadline is not None:
+                # each hop of a redirect or auth exchange gets what is left
+                remaining = req.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(filename=req.full_url)
+                if (timeout is None or
+                        timeout is socket._GLOBAL_DEFAULT_TIMEOUT or
+                        timeout > remaining):
+                    timeout = remaining
+            req.timeout = timeout
+            protocol = req.type
+
+            # pre-process request
+            for meth, is_coroutine in self._request_methods.get(protocol, ()):
+                req = meth(req)
+                if is_coroutine:
+                    req = yield from req
+                else:
+                    awaitable = _awaitable(req)
+                    if awaitable is not None:
+                        req = yield from awaitable
 
-        # pre-process request
-        meth_name = protocol+"_request"
-        for processor in self.process_request.get(protocol, []):
-            meth = getattr(processor, meth_name)
-            req = meth(req)
+            if req.deadline is None:
+                response = yield from self._hedged_open(req, data)
+            else:
+                remaining = req.deadline - time.monotonic()
+                try:
+                    response = yield from asyncio.wait_for(
+                        self._hedged_open(req, data), max(remaining, 0))
+                except asyncio.TimeoutError:
+                    if time.monotonic() < req.deadline:
+                        raise
+                    raise DeadlineExceeded(filename=req.full_url) from None
+
+            # post-process response
+            for meth, is_coroutine in self._response_methods.get(protocol, ()):
+                response = meth(req, response)
+                if is_coroutine:
+                    response = yield from response
+                else:
+                    awaitable = _awaitable(response)
+                    if awaitable is not None:
+                        response = yield from awaitable
 
-        response = yield from self._open(req, data)
+            return response
+        finally:
+            owner.deadline = previous
 
-        # post-process response
-        meth_name = protocol+"_response"
-        for processor in self.process_response.get(protocol, []):
-            meth = getattr(processor, meth_name)
-            response = yield from meth(req, response)
+    @asyncio.coroutine
+    def _hedged_open(self, req, data=None):
+        hedger = self.hedger
+        if (hedger is None or req.data is not None or
+                req.get_method() not in ('GET', 'HEAD')):
+            _r = yield from self._limited_open(req, data)
+            return _r
+        _r = yield from hedger.open(
+            req, lambda req: self._limited_open(req, data))
+        return _r
 
+    @asyncio.coroutine
+    def _limited_open(self, req, data=None):
+        # The limiter slot is held while the connection is in use: until
+        # the response body is read to the end or the response closed.
+        # error() gives it up early, since redirects and auth retries
+        # open nested requests that might be waiting for it.
+        limiter = self.limiter
+        if limiter is None:
+            _r = yield from self._open(req, data)
+            return _r
+        host = req.host
+        yield from limiter.acquire(host)
+        try:
+            response = yield from self._open(req, data)
+        except BaseException:
+            limiter.release(host)
+            raise
+        self._hold(response, limiter, host)
         return response
 
+    def _hold(self, response, limiter, host):
+        """Release host's slot in limiter once response is done with."""
+        close_conn = getattr(response, '_close_conn', None)
+        isclosed = getattr(response, 'isclosed', None)
+        if close_conn is None or isclosed is None or isclosed():
+            # not reading from a connection
+            limiter.release(host)
+            return
+        # runs once, at the latest when the response is collected
+        release = weakref.finalize(response, limiter.release, host)
+
+        def closed():
+            response._close_conn = close_conn
+            release()
+            close_conn()
+        response._close_conn = closed
+        self._held[response] = release
+
     @asyncio.coroutine
     def _open(self, req, data=None):
+        _r = yield from self._open_after(None, req)
+        return _r
+
+    @asyncio.coroutine
+    def _open_after(self, handler, req):
+        """Run the open chain for req, starting after handler.
 
-        result = yield from self._call_chain(self.handle_open, 'default', 'default_open', req)
+        A default_open method that wraps the rest of the chain (to retry
+        it, say) calls this with itself as handler.  With handler None
+        the whole chain runs.
+        """
+        methods = self._open_methods.get('default', ())
+        if handler is not None:
+            for i, (func, is_coroutine) in enumerate(methods):
+                if getattr(func, '__self__', None) is handler:
+                    methods = methods[i+1:]
+                    break
+        result = yield from self._run_methods(methods, req)
         if result:
             return result
 
@@ -503,6 +1486,20 @@ class OpenerDirector:
 
     @asyncio.coroutine
     def error(self, proto, *args):
+        if len(args) > 1:
+            # the error handlers may open further requests; the response
+            # holding the slot may be wrapped (by DecompressionHandler,
+            # say), so look down the chain of fp attributes for it
+            response = args[1]
+            while response is not None:
+                try:
+                    release = self._held.pop(response, None)
+                except TypeError:
+                    release = None
+                if release is not None:
+                    release()
+                    break
+                response = getattr(response, 'fp', None)
         if proto in ('http', 'https'):
             # XXX http[s] protocols are special-cased
             dict = self.handle_error['http'] # https is not different than http
@@ -683,33 +1680,878 @@ class HTTPRedirectHandler(BaseHandler):
         new = self.redirect_request(req, fp, code, msg, headers, newurl)
         if new is None:
             return
+        new.deadline = req.deadline
+
+        # loop detection
+        # .redirect_dict has a key url if url was previously visited.
+        if hasattr(req, 'redirect_dict'):
+            visited = new.redirect_dict = req.redirect_dict
+            if (visited.get(newurl, 0) >= self.max_repeats or
+                len(visited) >= self.max_redirections):
+                raise HTTPError(req.full_url, code,
+                                self.inf_msg + msg, headers, fp)
+        else:
+            visited = new.redirect_dict = req.redirect_dict = {}
+        visited[newurl] = visited.get(newurl, 0) + 1
+
+        # Don't close the fp until we are sure that we won't use it
+        # with HTTPError.
+        fp.read()
+        if hasattr(fp, 'close'):
+            fp.close()
+
+        _r = yield from self.parent.open(new, timeout=req.timeout)
+        return _r
+
+    http_error_301 = http_error_303 = http_error_307 = http_error_302
+
+    inf_msg = "The HTTP server returned a redirect error that would " \
+              "lead to an infinite loop.\n" \
+              "The last 30x error message was:\n"
+
+
+class _BufferedHTTPResponse(addinfourl):
+    """Response whose body has already been read into memory.
+
+    read, readinto and readline are coroutines, as on an HTTPResponse,
+    so this can stand in for one.  copy() returns another reader over
+    the same body.
+    """
+
+    __slots__ = ('body', 'status', 'reason', 'msg')
+
+    def __init__(self, body, headers, url, code=None, reason=None):
+        super(_BufferedHTTPResponse, self).__init__(
+            io.BytesIO(body), headers, url, code)
+        self.body = body
+        self.status = code
+        self.reason = self.msg = reason
+
+    def copy(self):
+        return _BufferedHTTPResponse(self.body, self.headers, self.url,
+                                     self.code, self.reason)
+
+    @asyncio.coroutine
+    def read(self, amt=None):
+        return self.fp.read(amt)
+
+    @asyncio.coroutine
+    def readinto(self, b):
+        return self.fp.readinto(b)
+
+    @asyncio.coroutine
+    def readline(self, limit=-1):
+        return self.fp.readline(limit)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+    def isclosed(self):
+        return self.fp.closed
+
+
+@asyncio.coroutine
+def _buffer_response(response, limit=None, bs=1024*64):
+    """Read response into a _BufferedHTTPResponse and close it.
+
+    With a limit, reading stops once the body is past limit bytes.  The
+    response is then left open and returned behind a reader that hands
+    out what was read before the rest.
+    """
+    passed_on = False
+    try:
+        if limit is None:
+            body = response.read()
+            awaitable = _awaitable(body)
+            if awaitable is not None:
+                body = yield from awaitable
+        else:
+            body = bytearray()
+            while True:
+                chunk = response.read(bs)
+                awaitable = _awaitable(chunk)
+                if awaitable is not None:
+                    chunk = yield from awaitable
+                if not chunk:
+                    break
+                body += chunk
+                if len(body) > limit:
+                    passed_on = True
+                    return _DecodedResponse(response, response.info(),
+                                            _IdentityDecoder(), body)
+            body = bytes(body)
+    finally:
+        if not passed_on:
+            response.close()
+    code = getattr(response, 'code', None)
+    if code is None:
+        code = getattr(response, 'status', None)
+    return _BufferedHTTPResponse(body, response.info(), response.geturl(),
+                                 code, getattr(response, 'reason', None))
+
+
+class _Flight:
+    """A fetch under way, and the number of requests that joined it."""
+
+    __slots__ = ('task', 'joiners', 'shared')
+
+    def __init__(self):
+        self.task = None
+        self.joiners = 0
+        self.shared = None
+
+
+class CoalescingHandler(BaseHandler):
+    """Share one fetch between identical concurrent safe requests.
+
+    A GET or HEAD that matches one already in flight (same method, URL
+    and headers) does not go out; it waits for the first and gets its
+    own reader over the buffered body.  With key_headers, only the named
+    request headers (those the server varies on, say) need to match.
+    coalesced counts the requests that were answered this way.
+
+    Requests can join until the response headers are in.  If none did,
+    the first request gets the response as it is, to read as it arrives;
+    otherwise the body is read into memory for all of them.  Past
+    max_bytes (None for no limit), the first request reads on from what
+    was buffered and the ones that joined are sent on their own.
+    """
+
+    # ahead of RetryHandler, so that a flight is retried once for all
+    handler_order = 25
+
+    safe_methods = frozenset(['GET', 'HEAD'])
+
+    def __init__(self, key_headers=None, max_bytes=16 * 1024 * 1024):
+        if key_headers is not None:
+            key_headers = frozenset(name.lower() for name in key_headers)
+        self.key_headers = key_headers
+        self.max_bytes = max_bytes
+        self.coalesced = 0
+        self._flights = {}
+
+    def key(self, req):
+        headers = [(name.lower(), value)
+                   for name, value in req.header_items()]
+        if self.key_headers is not None:
+            headers = [(name, value) for name, value in headers
+                       if name in self.key_headers]
+        return req.get_method(), req.full_url, tuple(sorted(headers))
+
+    @asyncio.coroutine
+    def _fetch(self, req, key, flight):
+        try:
+            _r = yield from self.parent._open_after(self, req)
+        finally:
+            # closed to joiners before anyone sees the response, so the
+            # count the callers go by is final
+            self._landed(key, flight)
+        return _r
+
+    def _landed(self, key, flight, task=None):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    @asyncio.coroutine
+    def default_open(self, req):
+        if req.data is not None or req.get_method() not in self.safe_methods:
+            return None
+        key = self.key(req)
+        flight = self._flights.get(key)
+        first = flight is None
+        if first:
+            flight = _Flight()
+            flight.task = asyncio.get_event_loop().create_task(
+                self._fetch(req, key, flight))
+            self._flights[key] = flight
+            flight.task.add_done_callback(
+                functools.partial(self._landed, key, flight))
+        else:
+            flight.joiners += 1
+        # one caller giving up must not cancel the fetch for the others
+        response = yield from asyncio.shield(flight.task)
+        if response is None:
+            return None
+        if not flight.joiners:
+            return response
+        if flight.shared is None:
+            flight.shared = asyncio.get_event_loop().create_task(
+                _buffer_response(response, self.max_bytes))
+        response = yield from asyncio.shield(flight.shared)
+        if not isinstance(response, _BufferedHTTPResponse):
+            # too large to share
+            return response if first else None
+        if not first:
+            self.coalesced += 1
+        return response.copy()
+
+
+def _http_date(value):
+    """Return the timestamp of an HTTP date, or None if it is invalid."""
+    if not value:
+        return None
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return email.utils.mktime_tz(date)
+
+def _parse_cache_control(values):
+    """Return the directives in Cache-Control header values as a dict.
+
+    Names are lowercased; directives without an argument map to None.
+    """
+    directives = {}
+    for value in values:
+        for item in value.split(','):
+            name, sep, arg = item.strip().partition('=')
+            name = name.strip().lower()
+            if name:
+                directives[name] = arg.strip().strip('"') if sep else None
+    return directives
+
+def _delta_seconds(directives, name):
+    """Return the integer argument of a directive, or None."""
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class CacheEntry:
+    """A stored response, with the times needed to work out its age.
+
+    headers is a list of (name, value) pairs; vary maps the (lowercased)
+    names of the request headers the response varies on to the values
+    they had in the request that fetched it.
+    """
+
+    def __init__(self, url, code, reason, headers, body,
+                 request_time, response_time, vary=None):
+        self.url = url
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.request_time = request_time
+        self.response_time = response_time
+        self.vary = vary or {}
+
+    def get_all(self, name):
+        name = name.lower()
+        return [value for key, value in self.headers if key.lower() == name]
+
+    def get(self, name, default=None):
+        values = self.get_all(name)
+        return values[0] if values else default
+
+    @property
+    def cache_control(self):
+        return _parse_cache_control(self.get_all('Cache-Control'))
+
+    def update_headers(self, headers):
+        """Replace stored headers by those of a 304 response."""
+        names = set(name.lower() for name, value in headers)
+        names.discard('content-length')
+        self.headers = [(name, value) for name, value in self.headers
+                        if name.lower() not in names]
+        self.headers.extend((name, value) for name, value in headers
+                            if name.lower() in names)
+
+    def current_age(self, now):
+        # RFC 7234, section 4.2.3
+        try:
+            age_value = max(0, int(self.get('Age', 0)))
+        except ValueError:
+            age_value = 0
+        date_value = _http_date(self.get('Date'))
+        if date_value is None:
+            date_value = self.response_time
+        apparent_age = max(0, self.response_time - date_value)
+        response_delay = self.response_time - self.request_time
+        corrected_age_value = age_value + response_delay
+        corrected_initial_age = max(apparent_age, corrected_age_value)
+        return corrected_initial_age + (now - self.response_time)
+
+    def to_dict(self):
+        return {'url': self.url, 'code': self.code, 'reason': self.reason,
+                'headers': self.headers, 'request_time': self.request_time,
+                'response_time': self.response_time, 'vary': self.vary}
+
+    @classmethod
+    def from_dict(cls, meta, body):
+        return cls(meta['url'], meta['code'], meta['reason'],
+                   [tuple(item) for item in meta['headers']], body,
+                   meta['request_time'], meta['response_time'], meta['vary'])
+
+
+class MemoryCache:
+    """In-memory storage for CacheHandler.
+
+    Entries are dropped least recently used first once there are more
+    than max_entries of them or their bodies add up to more than
+    max_bytes.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, entry):
+        self.delete(key)
+        if len(entry.body) > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.size += len(entry.body)
+        while (len(self._entries) > self.max_entries or
+               self.size > self.max_bytes):
+            key, entry = self._entries.popitem(last=False)
+            self.size -= len(entry.body)
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+class DiskCache:
+    """On-disk storage for CacheHandler.
+
+    Each entry is one file in directory, named by a hash of its key,
+    holding a line of JSON metadata followed by the body.  Files are
+    written under a temporary name and renamed into place, so a reader
+    never sees half an entry.  Once the files add up to more than
+    max_bytes, the least recently used are removed.
+
+    The methods block on file I/O; CacheHandler calls them from the
+    event loop's default executor.
+    """
+
+    blocking = True
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # size is kept up to date from executor threads
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for path, size, mtime in self._files())
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _files(self):
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stats = os.stat(path)
+            except OSError:
+                continue
+            yield path, stats.st_size, stats.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                body = f.read()
+            # the modification time doubles as the time of last use
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return CacheEntry.from_dict(meta, body)
+
+    def set(self, key, entry):
+        meta = json.dumps(entry.to_dict()).encode('utf-8')
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(meta + b'\n')
+                f.write(entry.body)
+            path = self._path(key)
+            try:
+                old_size = os.stat(path).st_size
+            except OSError:
+                old_size = 0
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+        with self._lock:
+            self.size += len(meta) + 1 + len(entry.body) - old_size
+            if self.size > self.max_bytes:
+                self._trim()
+
+    def delete(self, key):
+        path = self._path(key)
+        try:
+            size = os.stat(path).st_size
+            os.unlink(path)
+        except OSError:
+            return
+        with self._lock:
+            self.size -= size
+
+    def _trim(self):
+        files = sorted(self._files(), key=lambda item: item[2])
+        self.size = sum(size for path, size, mtime in files)
+        for path, size, mtime in files:
+            if self.size <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+                self.size -= size
+
+    def clear(self):
+        with self._lock:
+            for path, size, mtime in list(self._files()):
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+            self.size = 0
+
+
+class CacheHandler(BaseHandler):
+    """Private HTTP cache following RFC 7234.
+
+    GET responses are stored in storage (a MemoryCache unless another
+    backend is given) when their status and Cache-Control allow it, and
+    served from there while fresh: for max-age, or until Expires, or,
+    without either, for heuristic_fraction of the time since
+    Last-Modified, at most max_heuristic seconds.  Stale entries with an
+    ETag or Last-Modified are revalidated with a conditional request, a
+    304 answer being served from the cache.  Request Cache-Control
+    directives (no-store, no-cache, max-age, max-stale, min-fresh,
+    only-if-cached) are honoured, as is Vary, one variant being kept per
+    URL.  Successful unsafe requests invalidate the URL's entry.
+
+    The RFC 5861 extensions are honoured too.  Within the
+    stale-while-revalidate window a stale entry is served at once while
+    a background task revalidates it; within the stale-if-error window
+    it is served when the origin cannot be reached or answers with one
+    of error_codes.  max_stale_while_revalidate and max_stale_if_error
+    cap the windows a server may ask for.
+
+    Bodies larger than the storage's max_bytes are not stored, nor read
+    any further ahead than it takes to find out.  A storage whose
+    blocking attribute is true is called in the default executor, and
+    its methods may also return something to wait on.
+
+    hits, misses, revalidated and stale count how GET requests were
+    answered.
+    """
+
+    # in front of everything else, so that hits cost nothing further
+    handler_order = 20
+
+    cacheable_codes = frozenset([200, 203, 204, 300, 301, 404, 405, 410,
+                                 414, 501])
+    unsafe_methods = frozenset(['POST', 'PUT', 'DELETE', 'PATCH'])
+
+    # origin answers that stale-if-error may paper over
+    error_codes = frozenset([500, 502, 503, 504])
+
+    def __init__(self, storage=None, heuristic_fraction=0.1,
+                 max_heuristic=24 * 60 * 60, max_stale_while_revalidate=None,
+                 max_stale_if_error=None):
+        self.storage = MemoryCache() if storage is None else storage
+        self.heuristic_fraction = heuristic_fraction
+        self.max_heuristic = max_heuristic
+        self.max_stale_while_revalidate = max_stale_while_revalidate
+        self.max_stale_if_error = max_stale_if_error
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stale = 0
+        self._revalidating = set()
+
+    def freshness_lifetime(self, entry):
+        # RFC 7234, section 4.2.1; this cache is private, so s-maxage
+        # does not apply
+        max_age = _delta_seconds(entry.cache_control, 'max-age')
+        if max_age is not None:
+            return max_age
+        date = _http_date(entry.get('Date'))
+        if date is None:
+            date = entry.response_time
+        expires = entry.get('Expires')
+        if expires is not None:
+            expires = _http_date(expires)
+            # an invalid Expires means already expired
+            return 0 if expires is None else max(0, expires - date)
+        last_modified = _http_date(entry.get('Last-Modified'))
+        if last_modified is not None and entry.code in self.cacheable_codes:
+            return min(self.max_heuristic,
+                       max(0, date - last_modified) * self.heuristic_fraction)
+        return 0
+
+    def storable(self, req, response, directives):
+        # RFC 7234, section 3
+        code = getattr(response, 'code', None)
+        # entries are keyed on the URL alone, so only whole bodies go in
+        if code == 206 or req.has_header('Range'):
+            return False
+        req_directives = _request_cache_control(req)
+        if 'no-store' in directives or 'no-store' in req_directives:
+            return False
+        if response.info().get('Vary', '').strip() == '*':
+            return False
+        if (req.has_header('Authorization') and
+                not ('public' in directives or
+                     'must-revalidate' in directives or
+                     's-maxage' in directives)):
+            return False
+        limit = getattr(self.storage, 'max_bytes', None)
+        length = response.info().get('Content-Length', '').strip()
+        if limit is not None and length.isdigit() and int(length) > limit:
+            return False
+        return (code in self.cacheable_codes or
+                'max-age' in directives or 'public' in directives or
+                response.info().get('Expires') is not None)
+
+    @asyncio.coroutine
+    def _storage(self, name, *args):
+        """Call the storage's name method, off the loop if it blocks."""
+        method = getattr(self.storage, name)
+        if getattr(self.storage, 'blocking', False):
+            result = yield from asyncio.get_event_loop().run_in_executor(
+                None, method, *args)
+        else:
+            result = method(*args)
+        awaitable = _awaitable(result)
+        if awaitable is not None:
+            result = yield from awaitable
+        return result
+
+    def _matches(self, req, entry):
+        return all(req.get_header(name.capitalize()) == value
+                   for name, value in entry.vary.items())
+
+    def _respond(self, entry, age):
+        headers = email.message.Message()
+        for name, value in entry.headers:
+            if name.lower() != 'age':
+                headers[name] = value
+        headers['Age'] = str(int(age))
+        return _BufferedHTTPResponse(entry.body, headers, entry.url,
+                                     entry.code, entry.reason)
+
+    def _usable(self, req_directives, entry, age, lifetime):
+        """Return whether entry may be served without revalidation."""
+        directives = entry.cache_control
+        if 'no-cache' in directives or 'no-cache' in req_directives:
+            return False
+        max_age = _delta_seconds(req_directives, 'max-age')
+        if max_age is not None and age > max_age:
+            return False
+        min_fresh = _delta_seconds(req_directives, 'min-fresh')
+        if min_fresh is not None and lifetime - age < min_fresh:
+            return False
+        if age < lifetime:
+            return True
+        if 'max-stale' not in req_directives or \
+                'must-revalidate' in directives:
+            return False
+        max_stale = _delta_seconds(req_directives, 'max-stale')
+        return max_stale is None or age - lifetime <= max_stale
+
+    def _entry(self, req, response, body, request_time, response_time):
+        vary = {}
+        for value in response.info().get_all('Vary') or ():
+            for name in value.split(','):
+                name = name.strip().lower()
+                if name:
+                    vary[name] = req.get_header(name.capitalize())
+        return CacheEntry(req.full_url, body.code, body.reason,
+                          list(body.info().items()), body.body,
+                          request_time, response_time, vary)
+
+    @asyncio.coroutine
+    def default_open(self, req):
+        method = req.get_method()
+        if method != 'GET':
+            if method not in self.unsafe_methods:
+                return None
+            response = yield from self.parent._open_after(self, req)
+            code = getattr(response, 'code', None)
+            if code is not None and 200 <= code < 400:
+                yield from self._storage('delete', req.full_url)
+            return response
+
+        req_directives = _request_cache_control(req)
+        if ('no-store' in req_directives or
+                req.has_header('If-none-match') or
+                req.has_header('If-modified-since') or
+                req.has_header('Range')):
+            # the caller is managing this request itself
+            return None
+
+        key = req.full_url
+        entry = yield from self._storage('get', key)
+        if entry is not None and not self._matches(req, entry):
+            entry = None
+        if entry is not None:
+            age = entry.current_age(time.time())
+            lifetime = self.freshness_lifetime(entry)
+            if self._usable(req_directives, entry, age, lifetime):
+                self.hits += 1
+                return self._respond(entry, age)
+            if self._stale_while_revalidate(req_directives, entry,
+                                            age, lifetime):
+                self.stale += 1
+                if key not in self._revalidating:
+                    self._revalidating.add(key)
+                    asyncio.get_event_loop().create_task(
+                        self._revalidate(req, entry, key))
+                return self._respond(entry, age)
+        if 'only-if-cached' in req_directives:
+            headers = email.message_from_string("Content-length: 0\n")
+            return _BufferedHTTPResponse(b'', headers, req.full_url, 504,
+                                         'Gateway Timeout')
+
+        try:
+            response = yield from self._fetch(req, entry, key)
+        except DeadlineExceeded:
+            raise
+        except (URLError, socket.timeout, asyncio.TimeoutError):
+            if self._stale_if_error(req_directives, entry):
+                self.stale += 1
+                return self._respond(entry, entry.current_age(time.time()))
+            raise
+        code = getattr(response, 'code', None)
+        if (code in self.error_codes and
+                self._stale_if_error(req_directives, entry)):
+            response.close()
+            self.stale += 1
+            return self._respond(entry, entry.current_age(time.time()))
+        return response
+
+    def _stale_while_revalidate(self, req_directives, entry, age, lifetime):
+        # only for entries that are actually stale; a fresh one turned
+        # down by the request's own max-age or min-fresh goes to the origin
+        if age < lifetime or 'no-cache' in req_directives:
+            return False
+        max_age = _delta_seconds(req_directives, 'max-age')
+        if max_age is not None and age > max_age:
+            return False
+        if 'min-fresh' in req_directives:
+            return False
+        directives = entry.cache_control
+        if 'no-cache' in directives or 'must-revalidate' in directives:
+            return False
+        window = _delta_seconds(directives, 'stale-while-revalidate')
+        if window is None:
+            return False
+        if self.max_stale_while_revalidate is not None:
+            window = min(window, self.max_stale_while_revalidate)
+        return age - lifetime <= window
+
+    def _stale_if_error(self, req_directives, entry):
+        if entry is None:
+            return False
+        directives = entry.cache_control
+        if 'must-revalidate' in directives:
+            return False
+        # RFC 5861: the request may also allow it
+        windows = [window for window in
+                   (_delta_seconds(directives, 'stale-if-error'),
+                    _delta_seconds(req_directives, 'stale-if-error'))
+                   if window is not None]
+        if not windows:
+            return False
+        window = max(windows)
+        if self.max_stale_if_error is not None:
+            window = min(window, self.max_stale_if_error)
+        staleness = (entry.current_age(time.time()) -
+                     self.freshness_lifetime(entry))
+        return staleness <= window
+
+    @asyncio.coroutine
+    def _revalidate(self, req, entry, key):
+        try:
+            response = yield from self._fetch(_copy_request(req), entry, key)
+            if response is not None:
+                response.close()
+        except Exception:
+            # the stale copy stays; the next request will try again
+            pass
+        finally:
+            self._revalidating.discard(key)
+
+    @asyncio.coroutine
+    def _fetch(self, req, entry, key):
+        """Get req from the origin, revalidating entry if there is one."""
+        conditional = req
+        if entry is not None:
+            etag = entry.get('ETag')
+            last_modified = entry.get('Last-Modified')
+            if etag is not None or last_modified is not None:
+                conditional = _copy_request(req)
+                if etag is not None:
+                    conditional.add_unredirected_header('If-none-match', etag)
+                if last_modified is not None:
+                    conditional.add_unredirected_header('If-modified-since',
+                                                        last_modified)
+        request_time = time.time()
+        response = yield from self.parent._open_after(self, conditional)
+        response_time = time.time()
+        if response is None:
+            return None
+
+        if (conditional is not req and
+                getattr(response, 'code', None) == 304):
+            entry.update_headers(list(response.info().items()))
+            response.close()
+            entry.request_time = request_time
+            entry.response_time = response_time
+            yield from self._storage('set', key, entry)
+            self.revalidated += 1
+            return self._respond(entry, entry.current_age(time.time()))
+
+        self.misses += 1
+        directives = _parse_cache_control(
+            response.info().get_all('Cache-Control') or ())
+        if not self.storable(req, response, directives):
+            return response
+        body = yield from _buffer_response(
+            response, getattr(self.storage, 'max_bytes', None))
+        if not isinstance(body, _BufferedHTTPResponse):
+            # too big to store
+            return body
+        yield from self._storage('set', key, self._entry(
+            req, response, body, request_time, response_time))
+        return body.copy()
+
+
+def _request_cache_control(req):
+    value = req.get_header('Cache-control')
+    return _parse_cache_control([value] if value else ())
+
+
+def _parse_retry_after(value):
+    """Return the seconds a Retry-After header value asks for, or None."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+class RetryHandler(BaseHandler):
+    """Retry failed requests with exponential backoff and full jitter.
+
+    Connection errors, timeouts and responses whose status is in
+    retry_codes are retried, but only for idempotent methods and for
+    bodies that can be sent again.  The n-th retry waits a random time
+    between 0 and min(max_backoff, backoff_factor * 2**n) seconds, or
+    whatever a Retry-After header asks for, up to max_retry_after.
+
+    Each request gets at most max_retries retries; a Request can carry
+    its own limit in a max_retries attribute.  Retries also draw on a
+    budget shared by everything this opener sends: every first attempt
+    adds budget_ratio to it, every retry takes one away, and it never
+    holds more than budget_burst.  When it runs dry, failures are passed
+    through instead of retried, so a backend that is down is not
+    hammered with retries on top of the normal load.
+    """
 
-        # loop detection
-        # .redirect_dict has a key url if url was previously visited.
-        if hasattr(req, 'redirect_dict'):
-            visited = new.redirect_dict = req.redirect_dict
-            if (visited.get(newurl, 0) >= self.max_repeats or
-                len(visited) >= self.max_redirections):
-                raise HTTPError(req.full_url, code,
-                                self.inf_msg + msg, headers, fp)
-        else:
-            visited = new.redirect_dict = req.redirect_dict = {}
-        visited[newurl] = visited.get(newurl, 0) + 1
+    # go ahead of everything else, so that the whole chain is retried
+    handler_order = 50
+
+    idempotent_methods = frozenset(
+        ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+    def __init__(self, max_retries=3, retry_codes=(429, 502, 503, 504),
+                 backoff_factor=0.5, max_backoff=30.0, max_retry_after=120.0,
+                 budget_ratio=0.2, budget_burst=10):
+        self.max_retries = max_retries
+        self.retry_codes = frozenset(retry_codes)
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.budget = float(budget_burst)
+        self.retries = 0
+
+    def retryable(self, req):
+        if req.get_method() not in self.idempotent_methods:
+            return False
+        return req.data is None or isinstance(req.data, (bytes, bytearray))
 
-        # Don't close the fp until we are sure that we won't use it
-        # with HTTPError.
-        fp.read()
-        if hasattr(fp, 'close'):
-            fp.close()
+    def backoff(self, attempt):
+        limit = min(self.max_backoff, self.backoff_factor * (2 ** attempt))
+        return random.uniform(0, limit)
 
-        _r = yield from self.parent.open(new, timeout=req.timeout)
-        return _r
+    def retry_after(self, response):
+        """Return the delay asked for by a Retry-After header, or None."""
+        return _parse_retry_after(response.info().get('Retry-After'))
 
-    http_error_301 = http_error_303 = http_error_307 = http_error_302
+    def _time_for(self, req, delay):
+        # no point in waiting past the request's deadline
+        return req.deadline is None or time.monotonic() + delay < req.deadline
 
-    inf_msg = "The HTTP server returned a redirect error that would " \
-              "lead to an infinite loop.\n" \
-              "The last 30x error message was:\n"
+    def _take_budget(self):
+        if self.budget < 1:
+            return False
+        self.budget -= 1
+        self.retries += 1
+        return True
+
+    @asyncio.coroutine
+    def default_open(self, req):
+        self.budget = min(self.budget_burst, self.budget + self.budget_ratio)
+        if not self.retryable(req):
+            return None
+        max_retries = getattr(req, 'max_retries', None)
+        if max_retries is None:
+            max_retries = self.max_retries
+        attempt = 0
+        while True:
+            try:
+                response = yield from self.parent._open_after(self, req)
+            except (HTTPError, DeadlineExceeded, CircuitOpenError):
+                raise
+            except (URLError, socket.timeout, asyncio.TimeoutError):
+                delay = self.backoff(attempt)
+                if (attempt >= max_retries or
+                        not self._time_for(req, delay) or
+                        not self._take_budget()):
+                    raise
+            else:
+                code = getattr(response, 'code', None)
+                if (code not in self.retry_codes or attempt >= max_retries):
+                    return response
+                delay = self.retry_after(response)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                elif delay > self.max_retry_after:
+                    return response
+                if not self._time_for(req, delay) or not self._take_budget():
+                    return response
+                response.close()
+            attempt += 1
+            yield from asyncio.sleep(delay)
 
 
 def _parse_proxy(proxy):
@@ -741,6 +2583,236 @@ def _parse_proxy(proxy):
         user = password = None
     return scheme, user, password, hostport
 
+class _Circuit:
+    """Failure history and state of one host's circuit."""
+
+    def __init__(self, window):
+        self.state = 'closed'
+        self.outcomes = collections.deque(maxlen=window)
+        self.opened_at = 0.0
+        self.probes = 0
+        # bumped on every trip to half-open, to tell probes apart
+        self.generation = 0
+
+
+class CircuitBreakerHandler(BaseHandler):
+    """Fail fast on hosts that keep failing.
+
+    The outcome of the last window requests to each host is kept.  Once
+    at least min_requests are in and failure_ratio of them failed, the
+    host's circuit opens and requests to it raise CircuitOpenError at
+    once, with no connection attempt; RetryHandler does not retry those.
+    After reset_timeout seconds the circuit is half-open: up to
+    half_open_probes requests go through, and the first to finish closes
+    the circuit again if it succeeded or reopens it if it failed.
+
+    Connection errors, timeouts and responses with a status in
+    failure_codes (any 5xx by default) count as failures.
+    """
+
+    # beside ProxyHandler
+    handler_order = 100
+
+    def __init__(self, failure_ratio=0.5, min_requests=10, window=20,
+                 reset_timeout=30.0, half_open_probes=1, failure_codes=None):
+        if failure_codes is None:
+            failure_codes = range(500, 600)
+        self.failure_ratio = failure_ratio
+        self.min_requests = min_requests
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.failure_codes = frozenset(failure_codes)
+        self._circuits = {}
+
+    def state(self, host):
+        """Return 'closed', 'open' or 'half-open' for host."""
+        circuit = self._circuits.get(host)
+        if circuit is None:
+            return 'closed'
+        if (circuit.state == 'open' and
+                time.monotonic() - circuit.opened_at >= self.reset_timeout):
+            return 'half-open'
+        return circuit.state
+
+    def _allow(self, circuit):
+        """Return whether a request may go, and its probe tag.
+
+        The tag is None unless the request is a half-open probe.
+        """
+        if circuit.state == 'open':
+            if time.monotonic() - circuit.opened_at < self.reset_timeout:
+                return False, None
+            circuit.state = 'half-open'
+            circuit.probes = 0
+            circuit.generation += 1
+        if circuit.state == 'half-open':
+            if circuit.probes >= self.half_open_probes:
+                return False, None
+            circuit.probes += 1
+            return True, circuit.generation
+        return True, None
+
+    def _record(self, circuit, failed, probe=None):
+        if circuit.state == 'half-open':
+            # only this round's probes decide; requests that were sent
+            # before the circuit opened say nothing about it now
+            if probe != circuit.generation:
+                return
+            circuit.probes -= 1
+            if failed is None:
+                return
+            if failed:
+                circuit.state = 'open'
+                circuit.opened_at = time.monotonic()
+            else:
+                circuit.state = 'closed'
+                circuit.outcomes.clear()
+        elif circuit.state == 'closed' and failed is not None:
+            outcomes = circuit.outcomes
+            outcomes.append(failed)
+            if (len(outcomes) >= self.min_requests and
+                    sum(outcomes) >= self.failure_ratio * len(outcomes)):
+                circuit.state = 'open'
+                circuit.opened_at = time.monotonic()
+
+    @asyncio.coroutine
+    def default_open(self, req):
+        host = req.host
+        circuit = self._circuits.get(host)
+        if circuit is None:
+            circuit = self._circuits[host] = _Circuit(self.window)
+        allowed, probe = self._allow(circuit)
+        if not allowed:
+            raise CircuitOpenError(host)
+        # None means the outcome says nothing about the host (the
+        # request was cancelled, say)
+        failed = None
+        try:
+            response = yield from self.parent._open_after(self, req)
+            failed = getattr(response, 'code', None) in self.failure_codes
+            return response
+        except HTTPError as exc:
+            failed = exc.code in self.failure_codes
+            raise
+        except DeadlineExceeded:
+            # the caller ran out of time, which says little about the host
+            raise
+        except (URLError, socket.timeout, asyncio.TimeoutError):
+            failed = True
+            raise
+        finally:
+            self._record(circuit, failed, probe)
+
+
+class _TokenBucket:
+    """Token bucket whose tokens can be reserved ahead of time.
+
+    reserve() takes a token at once and returns how long the caller must
+    wait before using it, so waiters queue up in order without polling.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def refund(self):
+        self.tokens += 1
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+
+    def pause(self, delay):
+        """Hand out no tokens for the next delay seconds."""
+        self._refill()
+        self.tokens = min(self.tokens, -delay * self.rate)
+
+
+class RateLimitHandler(BaseHandler):
+    """Hold requests back to at most rate per second.
+
+    Requests draw tokens from a bucket that refills at rate tokens a
+    second and holds up to burst.  With per_host (the default) each host
+    has its own bucket, otherwise the opener shares one.  A request that
+    finds the bucket empty waits on an asyncio timer for its turn.
+
+    With adaptive set, a 429 response halves the host's rate (down to
+    min_rate) and stops its requests for as long as Retry-After asks;
+    every successful response then wins back a tenth of the configured
+    rate until it is reached again.
+    """
+
+    # ahead of CircuitBreakerHandler, after RetryHandler, so retries are
+    # held back too
+    handler_order = 75
+
+    def __init__(self, rate, burst=1, per_host=True, adaptive=False,
+                 min_rate=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst
+        self.per_host = per_host
+        self.adaptive = adaptive
+        self.min_rate = rate / 100 if min_rate is None else min_rate
+        self._buckets = {}
+
+    def bucket(self, host):
+        key = host if self.per_host else None
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _TokenBucket(self.rate, self.burst)
+        return bucket
+
+    @asyncio.coroutine
+    def default_open(self, req):
+        bucket = self.bucket(req.host)
+        delay = bucket.reserve()
+        if delay:
+            try:
+                yield from asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                bucket.refund()
+                raise
+        return None
+
+    def http_error_429(self, req, fp, code, msg, hdrs):
+        if self.adaptive:
+            bucket = self.bucket(req.host)
+            bucket.set_rate(max(self.min_rate, bucket.rate / 2))
+            delay = _parse_retry_after(hdrs.get('Retry-After'))
+            if delay:
+                bucket.pause(delay)
+        # let the error handlers further down deal with the response
+        return None
+
+    def http_response(self, req, response):
+        code = getattr(response, 'code', None)
+        if self.adaptive and code is not None and 200 <= code < 400:
+            bucket = self.bucket(req.host)
+            if bucket.rate < self.rate:
+                bucket.set_rate(min(self.rate, bucket.rate + self.rate / 10))
+        return response
+
+    https_response = http_response
+
+
 class ProxyHandler(BaseHandler):
     # Proxies must be in front
     handler_order = 100
@@ -762,8 +2834,10 @@ class ProxyHandler(BaseHandler):
         if proxy_type is None:
             proxy_type = orig_type
 
-        if req.host and proxy_bypass(req.host):
-            return None
+        if req.host:
+            bypass = yield from _proxy_bypass(req.host)
+            if bypass:
+                return None
 
         if user and password:
             user_pass = '%s:%s' % (unquote(user),
@@ -1126,10 +3200,112 @@ class ProxyDigestAuthHandler(BaseHandler, AbstractDigestAuthHandler):
         self.reset_retry_count()
         return retry
 
+class HTTPConnectionPool:
+    """Keep-alive connections for reuse by AbstractHTTPHandler.do_open.
+
+    Connections are keyed by connection class, host (or proxy), tunnel
+    host and the extra connection arguments such as the SSL context.  A
+    connection is offered back to the pool once its response body has
+    been read to the end, whether delimited by Content-Length or by the
+    terminating chunk of a chunked body; a response closed early takes
+    its connection down with it.  At most max_idle_per_host connections are kept for
+    each key, and connections idle for longer than max_idle_time seconds
+    are discarded rather than reused.
+    """
+
+    def __init__(self, max_idle_per_host=10, max_idle_time=60.0):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle_time = max_idle_time
+        self.hits = 0
+        self.misses = 0
+        self._idle = {}
+
+    def key(self, http_class, req, http_conn_args):
+        args = []
+        for name, value in sorted(http_conn_args.items()):
+            # HTTPSHandler gives each connection its own session proxy
+            if isinstance(value, _ResumingContext):
+                value = value._context
+            args.append((name, value))
+        return (http_class, req.host, req._tunnel_host) + tuple(args)
+
+    def acquire(self, key):
+        """Return an idle connection for key, or None."""
+        idle = self._idle.get(key)
+        now = time.monotonic()
+        while idle:
+            # most recently released first; it is the least likely to
+            # have been dropped by the server
+            conn, released = idle.pop()
+            if conn.sock is not None and now - released <= self.max_idle_time:
+                self.hits += 1
+                return conn
+            conn.close()
+        self._idle.pop(key, None)
+        self.misses += 1
+        return None
+
+    def release(self, key, conn):
+        """Return conn to the pool, or close it if the pool is full."""
+        idle = self._idle.setdefault(key, [])
+        now = time.monotonic()
+        while idle and now - idle[0][1] > self.max_idle_time:
+            idle.pop(0)[0].close()
+        if conn.sock is None or len(idle) >= self.max_idle_per_host:
+            conn.close()
+            return
+        idle.append((conn, now))
+
+    def watch(self, key, conn, response):
+        """Release conn to the pool when response is done with it."""
+        close_conn = getattr(response, '_close_conn', None)
+        if close_conn is None or getattr(response, 'will_close', True):
+            conn.close()
+            return
+
+        def done():
+            del response._close_conn
+            # Only a body that was read to the end is known to leave the
+            # socket at a message boundary.  HTTPResponse closes the
+            # connection itself on reaching the end of a length-delimited
+            # body or the last chunk, before close() has marked the
+            # response closed; a close() by the caller marks it first.
+            if (response.length == 0 or
+                    (getattr(response, 'chunked', False) and
+                     not getattr(response, 'closed', True))):
+                # detach rather than close; the stream belongs to conn
+                response.fp = None
+                self.release(key, conn)
+            else:
+                close_conn()
+                conn.close()
+        response._close_conn = done
+
+    def close(self):
+        """Close all idle connections."""
+        for idle in self._idle.values():
+            for conn, released in idle:
+                conn.close()
+        self._idle.clear()
+
+
 class AbstractHTTPHandler(BaseHandler):
 
-    def __init__(self, debuglevel=0):
+    # Connect to the addresses in the shared Resolver's cache instead of
+    # letting the connection look the host name up again.  Off by
+    # default: the cache holds answers for its full ttl.  HTTPS
+    # connections always get the name, which SNI and certificate checks
+    # need.
+    resolve_hosts = False
+
+    # how much of a file body is read for each write
+    body_blocksize = 1024*64
+
+    def __init__(self, debuglevel=0, pool=None, resolve_hosts=None):
         self._debuglevel = debuglevel
+        self._pool = pool
+        if resolve_hosts is not None:
+            self.resolve_hosts = resolve_hosts
 
     def set_http_debuglevel(self, level):
         self._debuglevel = level
@@ -1153,10 +3329,16 @@ class AbstractHTTPHandler(BaseHandler):
                 try:
                     mv = memoryview(data)
                 except TypeError:
-                    if isinstance(data, collections.Iterable):
-                        raise ValueError("Content-Length should be specified "
-                                "for iterable data of type %r %r" % (type(data),
-                                data))
+                    size = _file_size(data)
+                    if size is not None:
+                        request.add_unredirected_header(
+                                'Content-length', '%d' % size)
+                    elif (isinstance(data, collections.Iterable) or
+                            hasattr(data, 'read') or
+                            hasattr(type(data), '__aiter__')):
+                        # length unknown: stream it in chunks
+                        request.add_unredirected_header(
+                                'Transfer-encoding', 'chunked')
                 else:
                     request.add_unredirected_header(
                             'Content-length', '%d' % (len(mv) * mv.itemsize))
@@ -1184,45 +3366,116 @@ class AbstractHTTPHandler(BaseHandler):
         if not host:
             raise URLError('no host given')
 
-        # will parse host:port
-        h = http_class(host, timeout=req.timeout, **http_conn_args)
+        pool = self._pool
+        h = None
+        if pool is not None:
+            key = pool.key(http_class, req, http_conn_args)
+            h = pool.acquire(key)
+        reused = h is not None
+        # addresses to fall back on if connecting to the first fails
+        fallbacks = []
+        if reused:
+            h.timeout = req.timeout
+        else:
+            if self.resolve_hosts and not _is_https(http_class, req):
+                try:
+                    fallbacks = yield from _resolve_authorities(host)
+                except OSError as err:
+                    raise URLError(err)
+                host = fallbacks.pop(0)
+            # will parse host:port
+            h = http_class(host, timeout=req.timeout, **http_conn_args)
 
         headers = dict(req.unredirected_hdrs)
         headers.update(dict((k, v) for k, v in req.headers.items()
                             if k not in headers))
 
-        # TODO(jhylton): Should this be redesigned to handle
-        # persistent connections?
-
         # We want to make an HTTP/1.1 request, but the addinfourl
         # class isn't prepared to deal with a persistent connection.
         # It will try to read all remaining data from the socket,
         # which will block while the server waits for the next request.
-        # So make sure the connection gets closed after the (only)
-        # request.
-        headers["Connection"] = "close"
+        # So unless a pool is watching for the end of the response,
+        # make sure the connection gets closed after the (only) request.
+        if pool is None:
+            headers["Connection"] = "close"
         headers = dict((name.title(), val) for name, val in headers.items())
 
+        tunnel_headers = {}
         if req._tunnel_host:
-            tunnel_headers = {}
             proxy_auth_hdr = "Proxy-Authorization"
             if proxy_auth_hdr in headers:
                 tunnel_headers[proxy_auth_hdr] = headers[proxy_auth_hdr]
                 # Proxy-Authorization should not be sent to origin
                 # server.
                 del headers[proxy_auth_hdr]
-            h.set_tunnel(req._tunnel_host, headers=tunnel_headers)
-
-        try:
+            # a pooled connection is already tunnelled
+            if not reused:
+                h.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+
+        timeouts = req.timeouts or _NO_TIMEOUTS
+        connect_timeout = timeouts.connect
+        if timeouts.tls is not None and req.type == 'https':
+            connect_timeout = (connect_timeout or 0) + timeouts.tls
+        response_class = _HTTPResponse
+        if timeouts.read is not None or timeouts.body is not None:
+            response_class = _TimedHTTPResponse
+        h.response_class = response_class
+
+        def new_connection(host):
+            h = http_class(host, timeout=req.timeout, **http_conn_args)
+            if req._tunnel_host:
+                h.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            h.response_class = response_class
+            return h
+
+        while True:
             try:
-                yield from h.request(req.get_method(), req.selector, req.data, headers)
-            except OSError as err: # timeout error
-                raise URLError(err)
-            r = yield from h.getresponse()
+                try:
+                    while not reused and (connect_timeout is not None or
+                                          fallbacks):
+                        try:
+                            yield from _wait(h.connect(), connect_timeout,
+                                             'connect')
+                            break
+                        except OSError:
+                            # as create_connection() does, try the next
+                            if not fallbacks:
+                                raise
+                            h.close()
+                            h = new_connection(fallbacks.pop(0))
+                    yield from self._send_request(h, req, headers)
+                except OSError as err: # timeout error
+                    raise URLError(err)
+                r = yield from _wait(h.getresponse(), timeouts.first_byte,
+                                     'first byte')
+
+            except BaseException as e:
+                # also on cancellation, so that a hedged request that lost
+                # does not leave its connection half used
+                h.close()
+                # The server may have dropped an idle connection; try
+                # once more on a fresh one if the body can be resent.
+                # The request may have been written before the failure,
+                # so only methods that are safe to repeat qualify.
+                if (reused and isinstance(e, (URLError, client.HTTPException))
+                        and not isinstance(getattr(e, 'reason', None),
+                                           socket.timeout)
+                        and req.get_method() in
+                            RetryHandler.idempotent_methods
+                        and (req.data is None or isinstance(req.data, bytes))):
+                    reused = False
+                    h = new_connection(host)
+                    continue
+                raise
+            break
 
-        except Exception as e:
-            h.close()
-            raise
+        if isinstance(r, _TimedHTTPResponse):
+            r.read_timeout = timeouts.read
+            if timeouts.body is not None:
+                r.body_deadline = time.monotonic() + timeouts.body
+
+        if pool is not None:
+            pool.watch(key, h, r)
 
         # If the server does not send us a 'Connection: close' header,
         # HTTPConnection assumes the socket should be left open. Manually
@@ -1245,6 +3498,146 @@ class AbstractHTTPHandler(BaseHandler):
         return r
 
 
+    @asyncio.coroutine
+    def _send_request(self, h, req, headers):
+        """Send req on connection h, streaming a body that isn't a buffer.
+
+        Files, iterables of bytes and asynchronous iterators are sent a
+        block at a time, waiting for each to be written before taking
+        the next, in chunked framing unless a Content-Length was given.
+        """
+        data = req.data
+        try:
+            if data is not None:
+                memoryview(data)
+        except TypeError:
+            pass
+        else:
+            yield from h.request(req.get_method(), req.selector, data,
+                                 headers)
+            return
+
+        chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        h.putrequest(req.get_method(), req.selector,
+                     skip_host='Host' in headers,
+                     skip_accept_encoding='Accept-Encoding' in headers)
+        for name, value in headers.items():
+            h.putheader(name, value)
+        yield from h.endheaders()
+
+        @asyncio.coroutine
+        def send(block):
+            if isinstance(block, str):
+                raise TypeError("request body blocks should be bytes, "
+                                "not str")
+            if not block:
+                # an empty chunk would end a chunked body
+                return
+            if chunked:
+                block = b''.join([('%X\r\n' % len(block)).encode('ascii'),
+                                  block, b'\r\n'])
+            yield from h.send(block)
+
+        read = getattr(data, 'read', None)
+        aiter = getattr(type(data), '__aiter__', None)
+        if read is not None:
+            while True:
+                block = read(self.body_blocksize)
+                awaitable = _awaitable(block)
+                if awaitable is not None:
+                    block = yield from awaitable
+                if not block:
+                    break
+                yield from send(block)
+        elif aiter is not None:
+            iterator = aiter(data)
+            anext = type(iterator).__anext__
+            while True:
+                try:
+                    block = yield from _awaitable(anext(iterator))
+                except StopAsyncIteration:
+                    break
+                yield from send(block)
+        else:
+            for block in data:
+                yield from send(block)
+        if chunked:
+            yield from h.send(b'0\r\n\r\n')
+
+
+def _file_size(data):
+    """Return how much is left to read from a regular file, else None."""
+    try:
+        st = os.fstat(data.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return max(st.st_size - data.tell(), 0)
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+@asyncio.coroutine
+def _wait(coro, timeout, what):
+    """Run coro, raising socket.timeout if it takes more than timeout."""
+    if timeout is None:
+        _r = yield from coro
+        return _r
+    try:
+        _r = yield from asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout('%s timed out' % what) from None
+    return _r
+
+
+class _HTTPResponse(_Streaming, client.HTTPResponse):
+    """HTTPResponse with iter_chunks() and iter_lines()."""
+
+
+class _TimedHTTPResponse(_HTTPResponse):
+    """HTTPResponse whose body reads are bounded in time.
+
+    Each read or readline may take at most read_timeout seconds, and
+    none may run past body_deadline (a time.monotonic() value).  A read that times out
+    closes the response, dropping its connection, and raises
+    socket.timeout.
+    """
+
+    read_timeout = None
+    body_deadline = None
+
+    def _limit(self):
+        limit = self.read_timeout
+        if self.body_deadline is not None:
+            remaining = max(self.body_deadline - time.monotonic(), 0)
+            if limit is None or remaining < limit:
+                limit = remaining
+        return limit
+
+    @asyncio.coroutine
+    def _timed(self, coro, what):
+        try:
+            _r = yield from _wait(coro, self._limit(), what)
+        except socket.timeout:
+            self.close()
+            raise
+        return _r
+
+    @asyncio.coroutine
+    def read(self, amt=None):
+        _r = yield from self._timed(super().read(amt), 'read')
+        return _r
+
+    @asyncio.coroutine
+    def readinto(self, b):
+        _r = yield from self._timed(super().readinto(b), 'read')
+        return _r
+
+    @asyncio.coroutine
+    def readline(self, limit=-1):
+        _r = yield from self._timed(super().readline(limit), 'read')
+        return _r
+
+
 class HTTPHandler(AbstractHTTPHandler):
 
     @asyncio.coroutine
@@ -1254,19 +3647,105 @@ class HTTPHandler(AbstractHTTPHandler):
 
     http_request = AbstractHTTPHandler.do_request_
 
+class TLSSessionCache:
+    """TLS sessions kept for resumption by HTTPSHandler.
+
+    Sessions are keyed by host, port and SSL context.  Offering a stored
+    session lets the server skip the full handshake on a new connection.
+    hits counts handshakes that resumed a session and misses those that
+    did not; up to maxsize sessions are kept, least recently used first
+    out.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._sessions = collections.OrderedDict()
+
+    def get(self, key):
+        session = self._sessions.get(key)
+        if session is not None:
+            self._sessions.move_to_end(key)
+        return session
+
+    def put(self, key, session):
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.maxsize:
+            self._sessions.popitem(last=False)
+
+    def clear(self):
+        self._sessions.clear()
+
+
+class _ResumingContext:
+    """SSLContext stand-in that offers a cached session when wrapping.
+
+    The connection class wraps its socket (or BIO pair, under asyncio)
+    with whatever context it is given, so a session can be passed in
+    without the connection knowing about it.  One is made per connection.
+    """
+
+    def __init__(self, context, cache, key):
+        self._context = context
+        self._cache = cache
+        self._key = key
+        self._ssl_object = None
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def wrap_socket(self, *args, **kwargs):
+        kwargs.setdefault('session', self._cache.get(self._key))
+        self._ssl_object = self._context.wrap_socket(*args, **kwargs)
+        return self._ssl_object
+
+    def wrap_bio(self, *args, **kwargs):
+        kwargs.setdefault('session', self._cache.get(self._key))
+        self._ssl_object = self._context.wrap_bio(*args, **kwargs)
+        return self._ssl_object
+
+    def store(self):
+        """Count the handshake and keep its session for the next one."""
+        ssl_object = self._ssl_object
+        if ssl_object is None or ssl_object.session is None:
+            return
+        if ssl_object.session_reused:
+            self._cache.hits += 1
+        else:
+            self._cache.misses += 1
+        self._cache.put(self._key, ssl_object.session)
+
+
 if hasattr(client, 'HTTPSConnection'):
 
     class HTTPSHandler(AbstractHTTPHandler):
 
-        def __init__(self, debuglevel=0, context=None, check_hostname=None):
-            AbstractHTTPHandler.__init__(self, debuglevel)
+        def __init__(self, debuglevel=0, context=None, check_hostname=None,
+                     pool=None, session_cache=None):
+            AbstractHTTPHandler.__init__(self, debuglevel, pool)
             self._context = context
             self._check_hostname = check_hostname
+            # sessions can only be handed to the ssl module since 3.6
+            if not hasattr(ssl, 'SSLSession'):
+                session_cache = None
+            self._session_cache = session_cache
 
         @asyncio.coroutine
         def https_open(self, req):
+            context = self._context
+            if self._session_cache is not None:
+                if context is None:
+                    context = self._context = \
+                        ssl._create_default_https_context()
+                host, port = splitport(req._tunnel_host or req.host)
+                key = host, int(port or client.HTTPS_PORT), self._context
+                context = _ResumingContext(context, self._session_cache, key)
             _r = yield from self.do_open(client.HTTPSConnection, req,
-                context=self._context, check_hostname=self._check_hostname)
+                context=context, check_hostname=self._check_hostname)
+            if self._session_cache is not None:
+                context.store()
             return _r
 
         https_request = AbstractHTTPHandler.do_request_
@@ -1293,6 +3772,304 @@ class HTTPCookieProcessor(BaseHandler):
     https_request = http_request
     https_response = http_response
 
+# The decoders take max_length as zlib does: a call returns at most that
+# many bytes (0 for no limit) and keeps the input it didn't get to.
+# unconsumed is then true until calls with no new data have drained it;
+# only after that is more data passed in.
+
+class _GzipDecoder:
+    def __init__(self):
+        self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    @property
+    def unconsumed(self):
+        obj = self._obj
+        return bool(obj.unused_data if obj.eof else obj.unconsumed_tail)
+
+    def decompress(self, data, max_length=0):
+        obj = self._obj
+        if not obj.eof:
+            return obj.decompress(obj.unconsumed_tail + data, max_length)
+        # a body may hold several gzip members back to back
+        data = obj.unused_data + data
+        if not data:
+            return b''
+        self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return self._obj.decompress(data, max_length)
+
+    def flush(self):
+        if not self._obj.eof:
+            raise client.IncompleteRead(self._obj.flush())
+        return b''
+
+class _DeflateDecoder:
+    def __init__(self):
+        self._obj = zlib.decompressobj()
+        self._first = b''
+
+    @property
+    def unconsumed(self):
+        return not self._obj.eof and bool(self._obj.unconsumed_tail)
+
+    def decompress(self, data, max_length=0):
+        if self._first is None:
+            return self._obj.decompress(self._obj.unconsumed_tail + data,
+                                        max_length)
+        # Some servers send raw deflate data without the zlib wrapper;
+        # the first bytes tell which.
+        self._first += data
+        try:
+            out = self._obj.decompress(data, max_length)
+        except zlib.error:
+            first, self._first = self._first, None
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._obj.decompress(first, max_length)
+        if out:
+            self._first = None
+        return out
+
+    def flush(self):
+        if not self._obj.eof:
+            raise client.IncompleteRead(self._obj.flush())
+        return b''
+
+class _BrotliDecoder:
+    # Without output_buffer_limit (brotli before 1.1, brotlipy,
+    # brotlicffi) a call can't be bounded; input is then fed at most
+    # this much at a time.
+    input_size = 1024
+
+    def __init__(self):
+        self._obj = brotli.Decompressor()
+        self._tail = b''
+        self._bounded = hasattr(self._obj, 'can_accept_more_data')
+        # brotli calls it process(), brotlipy and brotlicffi decompress()
+        self._process = getattr(self._obj, 'process', None) or \
+                        self._obj.decompress
+
+    @property
+    def unconsumed(self):
+        if self._bounded:
+            return not self._obj.can_accept_more_data()
+        return bool(self._tail)
+
+    def decompress(self, data, max_length=0):
+        if self._bounded:
+            if max_length:
+                return self._process(data, output_buffer_limit=max_length)
+            return self._process(data)
+        data = self._tail + data
+        if max_length:
+            data, self._tail = (data[:self.input_size],
+                                data[self.input_size:])
+        return self._process(data)
+
+    def flush(self):
+        is_finished = getattr(self._obj, 'is_finished', None)
+        if is_finished is not None and not is_finished():
+            raise client.IncompleteRead(b'')
+        return b''
+
+class _IdentityDecoder:
+    """Pass a body through as it is."""
+
+    unconsumed = False
+
+    def decompress(self, data, max_length=0):
+        return data
+
+    def flush(self):
+        return b''
+
+class _ChainDecoder:
+    """Undo several content codings, listed in the order applied."""
+
+    def __init__(self, decoders):
+        self._decoders = decoders[::-1]
+
+    @property
+    def unconsumed(self):
+        return any(decoder.unconsumed for decoder in self._decoders)
+
+    def decompress(self, data, max_length=0):
+        # Start from the last decoder still holding input back, so that
+        # none is handed more before it has drained what it has.
+        start = 0
+        for i, decoder in enumerate(self._decoders):
+            if decoder.unconsumed:
+                start, data = i, b''
+        for decoder in self._decoders[start:]:
+            data = decoder.decompress(data, max_length)
+        return data
+
+    def flush(self):
+        data = b''
+        for decoder in self._decoders:
+            data = decoder.decompress(data) + decoder.flush()
+        return data
+
+
+class _DecodedResponse(addinfourl):
+    """Response whose body is decoded from its Content-Encoding as it
+    is read.
+
+    read, readinto and readline are coroutines, as on an HTTPResponse.
+    Only as much of the body is decoded as the reads ask for.  The
+    encoded response remains available as fp; anything else not
+    defined here, such as status and reason, comes from it.  buffered
+    is decoded data already taken off fp, handed out before the rest.
+    """
+
+    __slots__ = ('_decoder', '_buffer', '_eof')
+
+    chunk_size = 1024*16
+    # the most one call to the decoder may return, so that a small
+    # encoded body can't expand without bound in a single step
+    decoded_size = 1024*64
+    # the length of the encoded body says nothing about the decoded one
+    length = None
+
+    def __init__(self, response, headers, decoder, buffered=b''):
+        code = getattr(response, 'code', None)
+        if code is None:
+            code = getattr(response, 'status', None)
+        super(_DecodedResponse, self).__init__(response, headers,
+                                               response.geturl(), code)
+        self._decoder = decoder
+        self._buffer = bytearray(buffered)
+        self._eof = False
+
+    @asyncio.coroutine
+    def _fill(self, amt=None, line=False):
+        """Decode until amt bytes (a line, or everything) are buffered."""
+        buffer = self._buffer
+        while not self._eof:
+            if amt is not None and len(buffer) >= amt:
+                break
+            if line and b'\n' in buffer:
+                break
+            if self._decoder.unconsumed:
+                # what was held back by the last call comes first
+                buffer += self._decoder.decompress(b'', self.decoded_size)
+                continue
+            data = self.fp.read(self.chunk_size)
+            awaitable = _awaitable(data)
+            if awaitable is not None:
+                data = yield from awaitable
+            if data:
+                buffer += self._decoder.decompress(data, self.decoded_size)
+            else:
+                self._eof = True
+                buffer += self._decoder.flush()
+
+    def _take(self, amt):
+        buffer = self._buffer
+        if amt is None or amt >= len(buffer):
+            amt = len(buffer)
+        data = bytes(buffer[:amt])
+        del buffer[:amt]
+        return data
+
+    @asyncio.coroutine
+    def read(self, amt=None):
+        if amt is not None and amt < 0:
+            amt = None
+        yield from self._fill(amt)
+        return self._take(amt)
+
+    @asyncio.coroutine
+    def readinto(self, b):
+        data = yield from self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    @asyncio.coroutine
+    def readline(self, limit=-1):
+        if limit is not None and limit < 0:
+            limit = None
+        yield from self._fill(limit, line=True)
+        end = self._buffer.find(b'\n') + 1 or None
+        if limit is not None and (end is None or end > limit):
+            end = limit
+        return self._take(end)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+
+class DecompressionHandler(BaseHandler):
+    """Ask for compressed responses and decode them as they are read.
+
+    Requests that don't set their own Accept-Encoding advertise gzip,
+    deflate and, if the brotli module is importable, br.  A response
+    with a Content-Encoding it can undo is wrapped so that reads return
+    the decoded body, decoded a chunk at a time.  The wrapper's headers
+    drop Content-Encoding and Content-Length, which describe the
+    encoded body; the encoded response stays available as its fp.
+
+    Range requests are left alone: a range of an encoded body can't be
+    decoded on its own.
+    """
+
+    def __init__(self, encodings=None):
+        supported = ['gzip', 'deflate']
+        if brotli is not None:
+            supported.append('br')
+        if encodings is not None:
+            supported = [e for e in supported if e in encodings]
+        self.encodings = supported
+        self.accept_encoding = ', '.join(supported)
+
+    def _decoder(self, coding):
+        if coding in ('gzip', 'x-gzip') and 'gzip' in self.encodings:
+            return _GzipDecoder()
+        if coding == 'deflate' and 'deflate' in self.encodings:
+            return _DeflateDecoder()
+        if coding == 'br' and 'br' in self.encodings:
+            return _BrotliDecoder()
+        return None
+
+    def http_request(self, req):
+        if (self.accept_encoding and not req.has_header('Range') and
+                not req.has_header('Accept-encoding')):
+            req.add_unredirected_header('Accept-encoding',
+                                        self.accept_encoding)
+        return req
+
+    def http_response(self, req, response):
+        headers = response.info()
+        codings = [c.strip().lower()
+                   for c in ','.join(headers.get_all('Content-Encoding') or
+                                     ()).split(',')]
+        codings = [c for c in codings if c and c != 'identity']
+        code = getattr(response, 'code', None)
+        if code is None:
+            code = getattr(response, 'status', None)
+        if (not codings or code in (204, 206, 304) or
+                req.get_method() == 'HEAD'):
+            return response
+        decoders = []
+        for coding in codings:
+            decoder = self._decoder(coding)
+            if decoder is None:
+                return response
+            decoders.append(decoder)
+        decoded = email.message.Message()
+        for name, value in headers.items():
+            if name.lower() not in ('content-encoding', 'content-length'):
+                decoded[name] = value
+        if len(decoders) == 1:
+            decoder = decoders[0]
+        else:
+            decoder = _ChainDecoder(decoders)
+        return _DecodedResponse(response, decoded, decoder)
+
+    https_request = http_request
+    https_response = http_response
+
 class UnknownHandler(BaseHandler):
     def unknown_open(self, req):
         type = req.type
@@ -1359,7 +4136,8 @@ class FileHandler(BaseHandler):
         url = req.selector
         if url[:2] == '//' and url[2:3] != '/' and (req.host and
                 req.host != 'localhost'):
-            if not req.host in self.get_names():
+            names = yield from self._get_names()
+            if not req.host in names:
                 raise URLError("file:// scheme is supported only on localhost")
         else:
             ret = yield from self.open_local_file(req)
@@ -1368,6 +4146,8 @@ class FileHandler(BaseHandler):
     # names for the localhost
     names = None
     def get_names(self):
+        # Blocks on the lookups; kept for callers of the old interface.
+        # file_open() uses _get_names().
         if FileHandler.names is None:
             try:
                 FileHandler.names = tuple(
@@ -1377,10 +4157,23 @@ class FileHandler(BaseHandler):
                 FileHandler.names = (socket.gethostbyname('localhost'),)
         return FileHandler.names
 
+    @asyncio.coroutine
+    def _get_names(self):
+        # get_names() without blocking the event loop
+        if FileHandler.names is None:
+            resolver = _get_resolver()
+            localhost = yield from resolver.resolve('localhost', socket.AF_INET)
+            try:
+                thishost = yield from resolver.resolve(socket.gethostname(),
+                                                       socket.AF_INET)
+            except socket.gaierror:
+                thishost = []
+            FileHandler.names = tuple(localhost + thishost)
+        return FileHandler.names
+
     # not entirely sure what the rules are here
     @asyncio.coroutine
     def open_local_file(self, req):
-        yield None # make this a coroutine
         import email.utils
         import mimetypes
         host = req.host
@@ -1396,8 +4189,10 @@ class FileHandler(BaseHandler):
                 (mtype or 'text/plain', size, modified))
             if host:
                 host, port = splitport(host)
-            if not host or \
-                (not port and _safe_gethostbyname(host) in self.get_names()):
+                if not port:
+                    addr = yield from _safe_gethostbyname(host)
+                    names = yield from self._get_names()
+            if not host or (not port and addr in names):
                 if host:
                     origurl = 'file://' + host + filename
                 else:
@@ -1408,12 +4203,33 @@ class FileHandler(BaseHandler):
             raise URLError(exp)
         raise URLError('file not on local host')
 
+@asyncio.coroutine
 def _safe_gethostbyname(host):
     try:
-        return socket.gethostbyname(host)
+        _r = yield from _get_resolver().gethostbyname(host)
+        return _r
     except socket.gaierror:
         return None
 
+def _is_https(http_class, req):
+    https_class = getattr(client, 'HTTPSConnection', ())
+    return req.type == 'https' or (isinstance(http_class, type) and
+                                   issubclass(http_class, https_class))
+
+@asyncio.coroutine
+def _resolve_authorities(authority):
+    """Return host[:port] for each address the host name resolves to."""
+    host, port = splitport(authority)
+    addresses = yield from _get_resolver().resolve(host.strip('[]'))
+    authorities = []
+    for address in addresses:
+        if ':' in address:
+            address = '[%s]' % address
+        if port:
+            address = '%s:%s' % (address, port)
+        authorities.append(address)
+    return authorities
+
 class FTPHandler(BaseHandler):
 
     @asyncio.coroutine
@@ -1421,7 +4237,6 @@ class FTPHandler(BaseHandler):
         import ftplib
         import mimetypes
 
-        yield None # make this a coroutine
         host = req.host
         if not host:
             raise URLError('ftp error: no host given')
@@ -1442,7 +4257,7 @@ class FTPHandler(BaseHandler):
         passwd = passwd or ''
 
         try:
-            host = socket.gethostbyname(host)
+            host = yield from _get_resolver().gethostbyname(host)
         except OSError as msg:
             raise URLError(msg)
         path, attrs = splitattr(req.selector)
@@ -1742,23 +4557,7 @@ class URLopener:
                 result = filename, headers
                 if self.tempcache is not None:
                     self.tempcache[url] = result
-                bs = 1024*8
-                size = -1
-                read = 0
-                blocknum = 0
-                if "content-length" in headers:
-                    size = int(headers["Content-Length"])
-                if reporthook:
-                    reporthook(blocknum, bs, size)
-                while 1:
-                    block = yield from fp.read(bs)
-                    if not block:
-                        break
-                    read += len(block)
-                    tfp.write(block)
-                    blocknum += 1
-                    if reporthook:
-                        reporthook(blocknum, bs, size)
+                read, size = yield from _copy_response(fp, tfp, reporthook)
             finally:
                 tfp.close()
         finally:
@@ -1812,7 +4611,8 @@ class URLopener:
                     user_passwd, realhost = splituser(realhost)
                 if user_passwd:
                     selector = "%s://%s%s" % (urltype, realhost, rest)
-                if proxy_bypass(realhost):
+                bypass = yield from _proxy_bypass(realhost)
+                if bypass:
                     host = realhost
 
         if not host: raise OSError('http error', 'no host given')
@@ -1943,8 +4743,10 @@ class URLopener:
                 urlfile = 'file://' + file
             return addinfourl(open(localname, 'rb'), headers, urlfile)
         host, port = splitport(host)
-        if (not port
-           and socket.gethostbyname(host) in ((localhost(),) + thishost())):
+        if not port:
+            addr = yield from _get_resolver().gethostbyname(host)
+            local = yield from _local_addresses()
+        if not port and addr in local:
             urlfile = file
             if file[:1] == '/':
                 urlfile = 'file://' + file
@@ -1953,6 +4755,7 @@ class URLopener:
             return addinfourl(open(localname, 'rb'), headers, urlfile)
         raise URLError('local file error: not on local host')
 
+    @asyncio.coroutine
     def open_ftp(self, url):
         """Use FTP protocol."""
         if not isinstance(url, str):
@@ -1967,7 +4770,7 @@ class URLopener:
         host = unquote(host)
         user = unquote(user or '')
         passwd = unquote(passwd or '')
-        host = socket.gethostbyname(host)
+        host = yield from _get_resolver().gethostbyname(host)
         if not port:
             import ftplib
             port = ftplib.FTP_PORT
@@ -2299,6 +5102,23 @@ def thishost():
             _thishost = tuple(socket.gethostbyname_ex('localhost')[2])
     return _thishost
 
+@asyncio.coroutine
+def _local_addresses():
+    """Return (localhost(),) + thishost(), resolved without blocking."""
+    global _localhost, _thishost
+    resolver = _get_resolver()
+    if _localhost is None:
+        _localhost = yield from resolver.gethostbyname('localhost')
+    if _thishost is None:
+        try:
+            addresses = yield from resolver.resolve(socket.gethostname(),
+                                                    socket.AF_INET)
+        except socket.gaierror:
+            addresses = yield from resolver.resolve('localhost',
+                                                    socket.AF_INET)
+        _thishost = tuple(addresses)
+    return (_localhost,) + _thishost
+
 _ftperrors = None
 def ftperrors():
     """Return the set of errors raised by the FTP class."""
@@ -2319,6 +5139,91 @@ def noheaders():
 
 # Utility classes
 
+class Resolver:
+    """Asynchronous host name resolution with a TTL-bounded cache.
+
+    Lookups run through loop.getaddrinfo(), so a slow DNS server stalls
+    only the coroutines waiting on that name.  Answers are cached for
+    ttl seconds and failures for negative_ttl seconds, up to maxsize
+    names; concurrent lookups of one name share a single query.
+    """
+
+    def __init__(self, ttl=300.0, negative_ttl=30.0, maxsize=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self._pending = {}
+
+    @asyncio.coroutine
+    def resolve(self, host, family=socket.AF_UNSPEC):
+        """Return the list of addresses for host.
+
+        Raises socket.gaierror if the name does not resolve.
+        """
+        if _is_ip_address(host):
+            return [host]
+        key = host.lower(), family
+        entry = self._cache.get(key)
+        if entry is not None:
+            expires, result = entry
+            if expires > time.monotonic():
+                self._cache.move_to_end(key)
+                if isinstance(result, Exception):
+                    raise socket.gaierror(*result.args)
+                return result
+            del self._cache[key]
+        lookup = self._pending.get(key)
+        if lookup is None:
+            lookup = asyncio.get_event_loop().create_task(
+                self._lookup(key))
+            self._pending[key] = lookup
+            lookup.add_done_callback(lambda f: self._pending.pop(key, None))
+        # one waiter being cancelled must not cancel the shared lookup
+        _r = yield from asyncio.shield(lookup)
+        return _r
+
+    @asyncio.coroutine
+    def _lookup(self, key):
+        host, family = key
+        loop = asyncio.get_event_loop()
+        try:
+            infos = yield from loop.getaddrinfo(host, None, family=family,
+                                                type=socket.SOCK_STREAM)
+        except socket.gaierror as exc:
+            self._store(key, exc, self.negative_ttl)
+            raise
+        addresses = []
+        for _family, _type, _proto, _canonname, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        self._store(key, addresses, self.ttl)
+        return addresses
+
+    def _store(self, key, result, ttl):
+        self._cache[key] = time.monotonic() + ttl, result
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    @asyncio.coroutine
+    def gethostbyname(self, host):
+        """Coroutine version of socket.gethostbyname()."""
+        addresses = yield from self.resolve(host, socket.AF_INET)
+        return addresses[0]
+
+    def clear(self):
+        self._cache.clear()
+
+def _is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except (OSError, ValueError):
+            continue
+        return True
+    return False
+
 class ftpwrapper:
     """Class used by open_ftp() for cache of open FTP connections."""
 
@@ -2658,3 +5563,17 @@ else:
     # By default use environment variables
     getproxies = getproxies_environment
     proxy_bypass = proxy_bypass_environment
+
+
+@asyncio.coroutine
+def _proxy_bypass(host):
+    """proxy_bypass() for use on the event loop.
+
+    The macOS and Windows checks may look host names up, so they run in
+    the default executor; the environment check runs inline.
+    """
+    if proxy_bypass is proxy_bypass_environment or getproxies_environment():
+        return proxy_bypass_environment(host)
+    _r = yield from asyncio.get_event_loop().run_in_executor(
+        None, proxy_bypass, host)
+    return _r
@@ -6,24 +6,169 @@ addinfourl instance, which defines an info() method that returns
 headers and a geturl() method that returns the url.
 """
 
-import tempfile
+import asyncio
 
 __all__ = ['addbase', 'addclosehook', 'addinfo', 'addinfourl']
 
 
-class addbase(tempfile._TemporaryFileWrapper):
+def _awaitable(result):
+    """Return something yield from can drive if result is awaitable.
+
+    Covers generator and native coroutines, futures and any object with an
+    __await__ method.  Returns None for plain values.
+    """
+    if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+        return result
+    await_ = getattr(type(result), '__await__', None)
+    if await_ is not None:
+        return await_(result)
+    return None
+
+
+class _ChunkIterator:
+    """Asynchronous iterator over a response body, size bytes at a time.
+
+    Works with async for, and from yield from code through next(), which
+    returns None at the end of the body.
+    """
+
+    __slots__ = ('_stream', '_size')
+
+    def __init__(self, stream, size):
+        self._stream = stream
+        self._size = size
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def next(self):
+        chunk = self._stream.read(self._size)
+        awaitable = _awaitable(chunk)
+        if awaitable is not None:
+            chunk = yield from awaitable
+        return chunk or None
+
+    @asyncio.coroutine
+    def __anext__(self):
+        item = yield from self.next()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+
+class _LineIterator(_ChunkIterator):
+    """Asynchronous iterator over the lines of a response body.
+
+    Lines keep their b'\\n'; the last one may lack it.  Only the line
+    being assembled is held in memory.
+    """
+
+    __slots__ = ('_pending', '_scanned')
+
+    def __init__(self, stream, size):
+        super(_LineIterator, self).__init__(stream, size)
+        self._pending = bytearray()
+        self._scanned = 0
+
+    @asyncio.coroutine
+    def next(self):
+        pending = self._pending
+        while True:
+            end = pending.find(b'\n', self._scanned) + 1
+            if end:
+                line = bytes(pending[:end])
+                del pending[:end]
+                self._scanned = 0
+                return line
+            self._scanned = len(pending)
+            chunk = yield from super(_LineIterator, self).next()
+            if chunk is None:
+                line = bytes(pending)
+                del pending[:]
+                return line or None
+            pending += chunk
+
+
+class _Streaming:
+    """Mixin giving a response iter_chunks() and iter_lines().
+
+    Either can be used with async for, whether the response's read() is
+    a coroutine or a plain method:
+
+        async for chunk in response.iter_chunks(65536):
+            ...
+    """
+
+    __slots__ = ()
+
+    def iter_chunks(self, size=1024*8):
+        return _ChunkIterator(self, size)
+
+    def iter_lines(self, size=1024*8):
+        return _LineIterator(self, size)
+
+
+class addbase(_Streaming):
     """Base class for addinfo and addclosehook. Is a good idea for garbage collection."""
 
     # XXX Add a method to expose the timeout on the underlying socket?
 
+    # These are held by the thousand, so keep them small: no instance
+    # dict, and the common calls go straight to fp rather than through
+    # __getattr__.
+    __slots__ = ('fp', '__weakref__')
+
+    name = '<urllib response>'
+
     def __init__(self, fp):
-        super(addbase,  self).__init__(fp, '<urllib response>', delete=False)
         # Keep reference around as this was part of the original API.
         self.fp = fp
 
+    @property
+    def file(self):
+        return self.fp
+
+    def __getattr__(self, name):
+        # Everything else the file offers, e.g. fileno(), closed.
+        if name == 'fp':
+            raise AttributeError(name)
+        return getattr(self.fp, name)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def readline(self, *args):
+        return self.fp.readline(*args)
+
+    def readinto(self, b):
+        readinto = getattr(self.fp, 'readinto', None)
+        if readinto is not None:
+            return readinto(b)
+        # e.g. a StreamReader; like read(), the result is then awaitable
+        data = self.fp.read(len(b))
+        awaitable = _awaitable(data)
+        if awaitable is not None:
+            return self._copy_into(awaitable, b)
+        b[:len(data)] = data
+        return len(data)
+
+    @staticmethod
+    @asyncio.coroutine
+    def _copy_into(awaitable, b):
+        data = yield from awaitable
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.fp.close()
+
+    def __iter__(self):
+        return iter(self.fp)
+
     def __repr__(self):
         return '<%s at %r whose fp = %r>' % (self.__class__.__name__,
-                                             id(self), self.file)
+                                             id(self), self.fp)
 
     def __enter__(self):
         if self.fp.closed:
@@ -37,6 +182,8 @@ class addbase(tempfile._TemporaryFileWrapper):
 class addclosehook(addbase):
     """Class to add a close hook to an open file."""
 
+    __slots__ = ('closehook', 'hookargs')
+
     def __init__(self, fp, closehook, *hookargs):
         super(addclosehook, self).__init__(fp)
         self.closehook = closehook
@@ -53,6 +200,8 @@ class addclosehook(addbase):
 class addinfo(addbase):
     """class to add an info() method to an open file."""
 
+    __slots__ = ('headers',)
+
     def __init__(self, fp, headers):
         super(addinfo, self).__init__(fp)
         self.headers = headers
@@ -64,6 +213,8 @@ class addinfo(addbase):
 class addinfourl(addinfo):
     """class to add info() and geturl() methods to an open file."""
 
+    __slots__ = ('url', 'code')
+
     def __init__(self, fp, headers, url, code=None):
         super(addinfourl, self).__init__(fp, headers)
         self.url = url